@@ -0,0 +1,109 @@
+"""In-memory images shared by the steps run in one process.
+
+A step that saves an image hands it to the `ArtifactCache`, which writes it
+to disk on a background thread and keeps it in memory. The next step of the
+chain gets it from the cache instead of reading and decompressing the file.
+"""
+import logging
+from collections import OrderedDict
+from concurrent import futures
+
+
+class ArtifactCache(object):
+    """Images keyed by their path, evicted least recently used first.
+
+    Args:
+        budget (int): Memory in bytes for the cached images. With a budget
+                      of 0 nothing is cached and images are written as they
+                      are saved.
+
+    """
+
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.logger = logging.getLogger(__name__)
+        self._images = OrderedDict()
+        self._writes = {}
+        self._writer = futures.ThreadPoolExecutor(1)
+
+    @property
+    def nbytes(self):
+        return sum(img.dataobj.nbytes for img in self._images.values())
+
+    def put(self, fname, img, write):
+        """Cache an image and write it to disk in the background.
+
+        The image's data must not be modified after it is put in the cache.
+
+        Args:
+            fname (str): Path of the image.
+            img (Nifti1Image): The image, holding its data in memory.
+            write (function): Called with `img` and `fname` to save it.
+
+        """
+        self.wait(fname)
+        self._images.pop(fname, None)
+        if self.budget <= 0:
+            write(img, fname)
+            return
+
+        img.dataobj.flags.writeable = False
+        future = self._writer.submit(write, img, fname)
+        future.add_done_callback(self._log_error)
+        self._writes[fname] = future
+
+        self._images[fname] = img
+        while self._images and self.nbytes > self.budget:
+            self._images.popitem(last=False)
+
+    def get(self, fname):
+        """Get a cached image.
+
+        Args:
+            fname (str): Path of the image.
+
+        Returns:
+            img (Nifti1Image): The image, with read only data, or None if it
+                               is not cached.
+
+        """
+        if fname not in self._images:
+            return None
+        self._images.move_to_end(fname)
+        return self._images[fname]
+
+    def wait(self, fname=None):
+        """Wait until an image, or all the images, are written to disk.
+
+        When writes failed, all the writes are still waited for before the
+        first error is raised.
+
+        Args:
+            fname (str): Path of the image, or None for all the images.
+
+        Raises:
+            Exception: The error that stopped the image being written.
+
+        """
+        names = list(self._writes) if fname is None else [fname]
+        error = None
+        for name in names:
+            future = self._writes.pop(name, None)
+            if future is not None and future.exception() is not None:
+                # The file was not written, so its image is not kept either
+                self._images.pop(name, None)
+                error = error or future.exception()
+        if error is not None:
+            raise error
+
+    def clear(self):
+        """Wait for the pending writes and empty the cache."""
+        try:
+            self.wait()
+        finally:
+            self._images.clear()
+
+    def _log_error(self, future):
+        if future.exception() is not None:
+            self.logger.error(
+                f"could not save an image: {future.exception()}")
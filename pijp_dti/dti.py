@@ -1,13 +1,19 @@
+import argparse
 import csv
+import glob
 import os
 import tempfile
 import shutil
 import pickle
 import subprocess
+import sys
 import datetime
 import getpass
 import logging
 import random
+import itertools
+from concurrent import futures
+from multiprocessing import shared_memory
 
 import nibabel as nib
 import numpy as np
@@ -22,12 +28,17 @@ from pijp.exceptions import (ProcessingError, NoLogProcessingError,
 from pijp_nnicv.nnicv import SkullStripStep
 
 import pijp_dti
-from pijp_dti import dti_func, qc_main, qc_func
-from pijp_dti.repo import DTIRepo
+from pijp_dti import artifacts, dti_func, pgzip, qc_main, qc_func
+from pijp_dti.repo import get_repo
 
 
 LOGGER = logging.getLogger(__name__)
 PROCESS_TITLE = pijp_dti.__process_title__
+REVIEW_FLAG = "qc.inprocess"
+
+# Environment variable holding the `--registration-profile` option, so the
+# worker processes and the module run by `run_file` see it too
+PROFILE_VARIABLE = "PIJP_DTI_REGISTRATION_PROFILE"
 
 
 def get_process_dir(project):
@@ -55,6 +66,31 @@ def get_dcm2nii():
     return dcm2nii
 
 
+# The template FA and its labels Warp registers to each case
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+TEMPLATE = os.path.join(TEMPLATE_DIR, 'fa_template.nii')
+TEMPLATE_LABELS = os.path.join(TEMPLATE_DIR, 'fa_labels.nii')
+
+# Template images loaded by this process, see `_load_template`
+_TEMPLATES = {}
+
+# Shared memory of the templates of a batch worker, see `_attach_templates`
+_SHARED_BLOCKS = []
+
+
+def get_setting(name, default=None):
+    """Get a setting from the `pijp-dti` section of pijp.conf."""
+    try:
+        return util.configuration[PROCESS_TITLE][name]
+    except KeyError:
+        return default
+
+
+# Images saved by the steps of this process, see `DTIStep._save_nii`. They
+# are only kept in memory when pijp.conf gives them a `cache_mem` in MB.
+_ARTIFACTS = artifacts.ArtifactCache(get_setting('cache_mem', 0) * 2 ** 20)
+
+
 class DTIStep(Step):
 
     def __init__(self, project, code, args):
@@ -71,7 +107,8 @@ class DTIStep(Step):
 
         """
         super(DTIStep, self).__init__(project, code, args)
-        self.cpu = 2
+        self.cpu = get_setting('workers', 2)
+        self.gzip_threads = get_setting('gzip_threads', self.cpu)
         self.mem = 2048
         self.working_dir = get_case_dir(project, code)
         self.logdir = os.path.join(get_process_dir(project), 'logs', code)
@@ -84,13 +121,12 @@ class DTIStep(Step):
 
         # 1Denoise
         self.den_dir = os.path.join(self.working_dir, '1Denoise')
-        self.denoised = os.path.join(
-            self.den_dir, self.code + '_denoised.nii.gz')
+        self.denoised = self._intermediate(self.den_dir, '_denoised')
 
         # 2Register
         self.reg_dir = os.path.join(self.working_dir, '2Register')
         self.b0 = os.path.join(self.reg_dir, self.code + '_b0.nii.gz')
-        self.reg = os.path.join(self.reg_dir, self.code + '_reg.nii.gz')
+        self.reg = self._intermediate(self.reg_dir, '_reg')
         self.fbvec_orig = os.path.join(self.reg_dir, self.code +
                                        '_bvec_orig.csv')
         self.fbvec_reg = os.path.join(self.reg_dir, self.code +
@@ -112,7 +148,7 @@ class DTIStep(Step):
         self.final_mask = os.path.join(
             self.mask_dir, self.code + '_final_mask.nii.gz')
 
-        self.masked = os.path.join(self.mask_dir, self.code + '_masked.nii.gz')
+        self.masked = self._intermediate(self.mask_dir, '_masked')
 
         # 4Tenfit
         self.tenfit_dir = os.path.join(self.working_dir, '4Tenfit')
@@ -123,11 +159,12 @@ class DTIStep(Step):
         self.rd = os.path.join(self.tenfit_dir, self.code + '_rd.nii.gz')
         self.evals = os.path.join(self.tenfit_dir, self.code + '_evals.nii.gz')
         self.evecs = os.path.join(self.tenfit_dir, self.code + '_evecs.nii.gz')
+        self.tensor = os.path.join(self.tenfit_dir, self.code + '_tensor.npz')
 
         # 5Warp
         self.warp_dir = os.path.join(self.working_dir, '5Warp')
         self.warp_map = os.path.join(
-            self.warp_dir, self.code + '_warp_map.p')
+            self.warp_dir, self.code + '_warp_map.npz')
         self.warped_fa = os.path.join(
             self.warp_dir, self.code + '_inverse_warped_fa.nii.gz')
         self.warped_labels = os.path.join(
@@ -164,19 +201,73 @@ class DTIStep(Step):
             self.mni_dir, self.code + '_rd_in_mni.nii.gz')
 
         # templates
-        fpath = os.path.dirname(__file__)
-        self.template = os.path.join(fpath, 'templates', 'fa_template.nii')
-        self.template_labels = os.path.join(
-            fpath, 'templates', 'fa_labels.nii')
-        self.labels_lookup = os.path.join(fpath, 'templates', 'labels.npy')
-        self.review_flag = os.path.join(self.working_dir, "qc.inprocess")
-
-    def _load_nii(self, fname):
+        self.template = TEMPLATE
+        self.template_labels = TEMPLATE_LABELS
+        self.labels_lookup = os.path.join(TEMPLATE_DIR, 'labels.npy')
+        self.review_flag = os.path.join(self.working_dir, REVIEW_FLAG)
+
+    def _intermediate(self, directory, suffix):
+        """Get the path of a large 4D intermediate image.
+
+        Intermediates are only compressed when the `compress_intermediates`
+        setting is true, which is the default. Uncompressed intermediates
+        are quicker to write and are memory-mapped when loaded. An existing
+        file keeps its extension, so a case started in one mode can be
+        finished in the other.
+
+        Args:
+            directory (str): The step directory of the image.
+            suffix (str): The suffix after the code in the file name.
+
+        Returns:
+            path (str): The path to the '.nii' or '.nii.gz' image.
+
+        """
+        path = os.path.join(directory, self.code + suffix + '.nii')
+        if os.path.isfile(path + '.gz'):
+            return path + '.gz'
+        if os.path.isfile(path) or get_setting(
+                'compress_intermediates', True) is not True:
+            return path
+        return path + '.gz'
+
+    def _load_nii(self, fname, dtype=None):
+        """Load a Nifti image in its closest canonical orientation.
+
+        Floating point types apply the image's scaling in that precision,
+        e.g. float32 for DWIs. Integer types suit masks and label maps. An
+        uncompressed image that is stored as `dtype` stays memory-mapped,
+        so its slices are only read from disk when they are used. Images
+        written by `_save_nii` are decompressed on `gzip_threads` threads,
+        or taken from memory when they were saved in this process. Those
+        arrays are read only.
+
+        Args:
+            fname (str): Path to the image.
+            dtype (type): The type of the returned array, or None for the
+                          type stored in the image.
+
+        Returns:
+            dat (ndarray): The image data.
+            aff (ndarray): 4 X 4 affine of the image.
+
+        """
         try:
             self.logger.info('loading {}'.format(fname.split('/')[-1]))
-            img = nib.load(fname)
+            img = _ARTIFACTS.get(fname)
+            if img is None:
+                _ARTIFACTS.wait(fname)
+                if fname.endswith('.gz'):
+                    img = pgzip.load_nifti(fname, self.gzip_threads)
+            if img is None:
+                img = nib.load(fname)
             img = nib.as_closest_canonical(img)
-            dat = img.get_data()
+            if dtype is not None and np.issubdtype(dtype, np.floating):
+                dat = img.get_fdata(dtype=dtype, caching='unchanged')
+            else:
+                dat = np.asanyarray(img.dataobj)
+                if dtype is not None:
+                    dat = dat.astype(dtype, copy=False)
             aff = img.affine
             return dat, aff
 
@@ -201,9 +292,72 @@ class DTIStep(Step):
             raise e
 
     def _save_nii(self, dat, aff, fname):
+        """Save a Nifti image.
+
+        With a `cache_mem` setting, the image is kept in memory for the next
+        steps, up to `cache_mem` MB, and written on a background thread.
+        `dat` must not be modified after it is saved. Use `_ARTIFACTS.wait`
+        before reading the file without `_load_nii`, and end the step with
+        `_wait_for_writes`.
+
+        Args:
+            dat (ndarray): The image data.
+            aff (ndarray): 4 X 4 affine of the image.
+            fname (str): Path of the '.nii' or '.nii.gz' image.
+
+        """
         self.logger.info(f"saving {fname.split('/')[-1]}")
         img = nib.Nifti1Image(dat, aff)
-        img.to_filename(fname)
+        _ARTIFACTS.put(fname, img, self._write_nii)
+
+    def _wait_for_writes(self):
+        """Wait until the images saved by the step are written to disk.
+
+        A step is only done once its files exist, so an image that could not
+        be written is an error and stops the chain of steps.
+
+        """
+        try:
+            _ARTIFACTS.wait()
+        except Exception as e:
+            self.logger.error(f"Could not save an image: {e}")
+            self.outcome = 'Error'
+            self.comments = str(e)
+            self.next_step = None
+
+    def _write_nii(self, img, fname):
+        if fname.endswith('.gz'):
+            pgzip.save_nifti(img, fname, get_setting('gzip_level', 1),
+                             self.gzip_threads)
+        else:
+            img.to_filename(fname)
+
+    @property
+    def repo(self):
+        """The database repository shared by the steps of this process."""
+        return get_repo()
+
+    def _registration_params(self):
+        """Get the registration parameters for the project.
+
+        The `--registration-profile` option picks the profile. Without it,
+        the project's `RegistrationProfile` setting picks it, and the
+        profile is 'default' when the project has none or an unknown one.
+        Parameters in the `registration` section of the pijp-dti settings
+        override the profile.
+
+        """
+        profile = os.environ.get(PROFILE_VARIABLE)
+        if not profile:
+            profile = self.repo.get_registration_profile(self.project)
+        if profile not in dti_func.REGISTRATION_PROFILES:
+            self.logger.warning(f"Unknown registration profile '{profile}', "
+                                f"using the default profile")
+            profile = 'default'
+        self.logger.info(f"Using the {profile} registration profile")
+
+        return dti_func.registration_params(
+            profile, **get_setting('registration', {}))
 
     def _run_cmd(self, cmd):
         self.logger.debug(cmd)
@@ -262,6 +416,46 @@ class BaseQCStep(DTIStep):
             return True
         return False
 
+    @classmethod
+    def next_case(cls, project_name, args, cases, resume=None):
+        """Pick the next case to review that no one else is reviewing.
+
+        The review flags of the project are read once, so cases under
+        review are skipped without making a step for each of them.
+
+        Args:
+            project_name (str): The name of the project.
+            args (str): Optional arguments.
+            cases (list): Codes of the cases waiting for review.
+            resume (str): Code of a case to review first, if it is free.
+
+        Returns:
+            step (BaseQCStep): The step of the next case, or None if every
+                               case is under review.
+
+        """
+        flagged = cls.under_review_codes(project_name)
+        if cases and resume is not None and resume not in flagged:
+            next_job = cls(project_name, resume, args)
+            if not next_job.under_review():
+                return next_job
+
+        cases = [code for code in cases if code not in flagged]
+        while len(cases) != 0:
+            code = cases.pop(random.randrange(len(cases)))
+            next_job = cls(project_name, code, args)
+            # The case may have been picked since the flags were read
+            if not next_job.under_review():
+                return next_job
+
+    @staticmethod
+    def under_review_codes(project_name):
+        """Get the codes of the cases of a project that are under review."""
+        pattern = os.path.join(
+            glob.escape(get_process_dir(project_name)), '*', REVIEW_FLAG)
+        return {os.path.basename(os.path.dirname(flag))
+                for flag in glob.glob(pattern)}
+
     def _print_review_info(self):
         flag = open(self.review_flag, 'r')
         lines = flag.readlines()
@@ -288,6 +482,8 @@ class BaseQCStep(DTIStep):
         """
         try:
             self.set_qc_params()
+            # The GUI reads and edits the images on disk
+            _ARTIFACTS.clear()
 
             result, comments = qc_main.main(
                 self.project, self.code, self.mode,
@@ -332,10 +528,12 @@ class Stage(DTIStep):
         """Runs the step `Stage`.
 
         Creates the directories for all the steps. Finds the DICOMs for the
-        code in the database, copies them  to a temporary directory,
+        code in the database, links or copies them to a temporary directory,
         then finally converts them to the Nifti format using dcm2nii/dcm2niix.
         The staged files are stored in the `0Stage` directory and are
-        verified as an Diffusion Weighted Image (DWI).
+        verified as an Diffusion Weighted Image (DWI) from the Nifti header.
+        The DWI is only rewritten when it is not in its closest canonical
+        orientation.
 
         """
         self.logger.info("Staging pipeline")
@@ -359,16 +557,17 @@ class Stage(DTIStep):
             else:
                 self._convert_with_dcm2niix(source)
 
-            dat, aff = self._load_nii(self.fdwi)
-            self._save_nii(dat, aff, self.fdwi)
+            img = nib.load(self.fdwi)
             read_bvals_bvecs(self.fbval, self.fbvec)  # Raises IOError if not
 
-            if len(dat.shape) != 4:
+            if len(img.shape) != 4:
                 self.outcome = 'Error'
-                self.comments = (f"{self.fdwi} has {dat.shape} dimension(s). "
+                self.comments = (f"{self.fdwi} has {img.shape} dimension(s). "
                                  f"DWI must have 4 dimensions.")
                 self.logger.info(self.comments)
                 self.next_step = None
+            else:
+                self._reorient(img, self.fdwi)
 
         except FileNotFoundError:
             self.next_step = None
@@ -391,23 +590,79 @@ class Stage(DTIStep):
                 'This will delete everything in the case directory!')
             self.next_step = None
 
+    def _reorient(self, img, fname):
+        """Rewrite a 4D image in its closest canonical orientation.
+
+        An image that is already canonical is left as it is. Otherwise the
+        file is decompressed once, in order, and its volumes are reoriented
+        and written one at a time, so the whole image is never in memory.
+        The stored values, data type and scaling are kept.
+
+        Args:
+            img (Nifti1Image): The image, as loaded from `fname`.
+            fname (str): Path of the '.nii.gz' image.
+
+        """
+        ornt = nib.io_orientation(img.affine)
+        if np.array_equal(ornt, [[0, 1], [1, 1], [2, 1]]):
+            return
+
+        self.logger.info(f"reorienting {fname.split('/')[-1]}")
+        shape = img.shape
+        dtype = img.dataobj.dtype
+        vol_shape = shape[:3]
+        vol_bytes = int(np.prod(vol_shape)) * dtype.itemsize
+
+        hdr = self._canonical_header(img, ornt)
+
+        tmp = fname + '.tmp'
+        with nib.openers.ImageOpener(fname) as src, \
+                pgzip.GzipWriter(tmp, get_setting('gzip_level', 1),
+                                 self.gzip_threads) as dst:
+            hdr.write_to(dst)
+            dst.seek(int(hdr['vox_offset']))
+            # A single pass, seeking back in a gzip stream decompresses it
+            # again from the start
+            src.seek(img.dataobj.offset)
+            for i in range(0, shape[3]):
+                vol = np.frombuffer(src.read(vol_bytes), dtype).reshape(
+                    vol_shape, order='F')
+                vol = nib.apply_orientation(vol, ornt)
+                dst.write(vol.astype(hdr.get_data_dtype()).tobytes(
+                    order='F'))
+        os.replace(tmp, fname)
+
+    @staticmethod
+    def _canonical_header(img, ornt):
+        """Get the header of a 4D image reoriented like its volumes."""
+        volume = nib.Nifti1Image(
+            np.empty(img.shape[:3] + (1,), img.dataobj.dtype), img.affine,
+            img.header).as_reoriented(ornt)
+        hdr = volume.header
+        hdr.set_data_shape(volume.shape[:3] + img.shape[3:])
+        # A loaded image keeps its scaling in `dataobj`, not in its header
+        hdr.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+        return hdr
+
     def _convert_with_dcm2niix(self, source):
         self.logger.info('Using dcm2niix')
         dcm2niix = get_dcm2niix()
-        dcm_dir = self._copy_files(source)
-        self.logger.info("Converting DICOM files to NIfTI")
-        cmd = f"{dcm2niix} -z i -m y -o {self.stage_dir} " \
-              f"-f {self.code} {dcm_dir}"
+        with tempfile.TemporaryDirectory() as tmp:
+            dcm_dir = self._copy_files(source, tmp)
+            self.logger.info("Converting DICOM files to NIfTI")
+            cmd = f"{dcm2niix} -z i -m y -o {self.stage_dir} " \
+                  f"-f {self.code} {dcm_dir}"
 
-        self._run_cmd(cmd)
+            self._run_cmd(cmd)
 
     def _convert_with_dcm2nii(self, source):
         self.logger.info('Using dcm2nii')
         dcm2nii = get_dcm2nii()
-        dcm_dir = self._copy_files(source)
-        self.logger.info("Converting DICOM files to NIfTI")
-        cmd = '{} -o {} {}'.format(dcm2nii, self.stage_dir, dcm_dir)
-        self._run_cmd(cmd)
+        with tempfile.TemporaryDirectory() as tmp:
+            dcm_dir = self._copy_files(source, tmp)
+            self.logger.info("Converting DICOM files to NIfTI")
+            cmd = '{} -o {} {}'.format(dcm2nii, self.stage_dir, dcm_dir)
+            self._run_cmd(cmd)
         for file in os.listdir(self.stage_dir):  # rename the dcm2nii files
             abs_path = os.path.join(self.stage_dir, file)
             ext = file.split('.')
@@ -421,22 +676,58 @@ class Stage(DTIStep):
         shutil.rmtree(
             get_case_dir(self.project, self.code), ignore_errors=True)
 
-    def _copy_files(self, source):
-        tmp = tempfile.mkdtemp()
-        self.logger.debug("Copying %s files..." % (len(source)))
+    def _copy_files(self, source, tmp):
+        """Gather the DICOM files in a temporary directory.
+
+        With the `stage_files` setting 'link', the default, the files are
+        hard linked, or symlinked across file systems, and only copied when
+        neither is allowed. With 'copy' they are always copied. Files are
+        staged on `stage_threads` threads.
+
+        Args:
+            source (list): Paths of the DICOM files.
+            tmp (str): The temporary directory.
+
+        Returns:
+            dcm_path (str): Path of the first staged DICOM file.
+
+        """
+        self.logger.debug("Staging %s files..." % (len(source)))
+        link = get_setting('stage_files', 'link') == 'link'
+        # Files with the same name replace each other, the last one is kept
+        staged = {os.path.basename(src): src for src in source}
+
+        with futures.ThreadPoolExecutor(
+                get_setting('stage_threads', 8)) as pool:
+            list(pool.map(
+                lambda src: self._stage_file(src, tmp, link),
+                staged.values()))
 
-        for src in source:
-            dst = os.path.join(tmp, os.path.basename(src))
-            self.logger.debug("Copying file: %s -> %s" % (src, dst))
-            shutil.copyfile(src, dst)
-            if not os.path.exists(dst):
-                raise Exception("Failed to copy file: %s" % dst)
         return os.path.join(tmp, os.path.basename(source[0]))
 
+    def _stage_file(self, src, tmp, link):
+        dst = os.path.join(tmp, os.path.basename(src))
+        if link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+            try:
+                os.symlink(os.path.abspath(src), dst)
+                return
+            except OSError:
+                pass
+
+        self.logger.debug("Copying file: %s -> %s" % (src, dst))
+        shutil.copyfile(src, dst)
+        if not os.path.exists(dst):
+            raise Exception("Failed to copy file: %s" % dst)
+
     @classmethod
     def get_queue(cls, project_name):
-        staged = DTIRepo().get_staged_cases(project_name)
-        dtis = DTIRepo().get_project_dtis(project_name)
+        staged = get_repo().get_staged_cases(project_name)
+        dtis = get_repo().get_project_dtis(project_name)
 
         staged_codes = [row['Code'] for row in staged]
         todo = [{'ProjectName': project_name, "Code": row['Code']}
@@ -460,17 +751,25 @@ class Denoise(DTIStep):
         """Runs the step `Denoise`.
 
         Loads all the staged data. Denoises the staged DWI by calling
-        a denoising function.
+        a denoising function, in slabs that fit in part of the step's memory.
+        The faster non local means is used instead of local PCA when the
+        `denoise_method` setting is 'nlm'.
 
         """
         try:
             # Loading
-            dat, aff = self._load_nii(self.fdwi)
+            dat, aff = self._load_nii(self.fdwi, dtype=np.float32)
             bval, bvec = self._load_bval_bvec(self.fbval, self.fbvec)
 
             # Running
-            self.logger.info("Denoising the DWI")
-            denoised = dti_func.denoise_pca(dat, bval, bvec)
+            if get_setting('denoise_method', 'pca') == 'nlm':
+                self.logger.info("Denoising the DWI with non local means")
+                denoised = dti_func.denoise(dat, workers=self.cpu)
+            else:
+                self.logger.info("Denoising the DWI")
+                denoised = dti_func.denoise_pca(
+                    dat, bval, bvec, workers=self.cpu,
+                    mem=get_setting('denoise_mem', self.mem // 2))
 
             # Saving
             self._save_nii(denoised, aff, self.denoised)
@@ -480,6 +779,8 @@ class Denoise(DTIStep):
         except IOError:
             self.next_step = None
 
+        self._wait_for_writes()
+
 
 class Register(DTIStep):
     """Rigidly register the DWI to its averaged b0 volume."""
@@ -497,20 +798,25 @@ class Register(DTIStep):
 
         The b0 is generated by finding all the b0's in the DWI and rigidly
         registers them to the first found b0 volume. The rest of the diffusion
-        weighted volumes are then registered to the averaged b0 volume.
+        weighted volumes are then registered to the averaged b0 volume,
+        spread over `self.cpu` worker processes. The b0 volumes keep the
+        transforms found while averaging rather than being registered twice.
 
         """
         try:
             # Loading
-            dat, aff = self._load_nii(self.denoised)
+            dat, aff = self._load_nii(self.denoised, dtype=np.float32)
             bval, bvec = self._load_bval_bvec(self.fbval, self.fbvec)
 
             # Running
             self.logger.info('Averaging the b0 volume')
-            b0 = dti_func.average_b0(dat, aff, bval)
+            params = self._registration_params()
+            b0, b0_reg = dti_func.average_b0(
+                dat, aff, bval, return_reg=True, **params)
             self.logger.info('Registering the DWI to its averaged b0 volume')
             reg_dat, bvec_reg, reg_map = dti_func.register(
-                b0, dat, aff, aff, bval, bvec)
+                b0, dat, aff, aff, bval, bvec, workers=self.cpu, b0_reg=b0_reg,
+                warm_start=get_setting('warm_start', False), **params)
 
             # Saving
             self._save_nii(b0, aff, self.b0)
@@ -526,6 +832,8 @@ class Register(DTIStep):
         except IOError:
             self.next_step = None
 
+        self._wait_for_writes()
+
 
 class Mask(DTIStep):
     """Skull strip the average b0 volume."""
@@ -549,18 +857,18 @@ _
             # Loading
             dat, aff = self._load_nii(self.b0)
 
-            use_nnicv = DTIRepo().get_project_settings(self.project)[
+            use_nnicv = self.repo.get_project_settings(self.project)[
                 'UseNNICV']
 
-            scancode = DTIRepo().get_scancode(self.code)
-            t1_code = DTIRepo().get_t1(self.project, scancode)
+            scancode = self.repo.get_scancode(self.code)
+            t1_code = self.repo.get_t1(self.project, scancode)
 
             if t1_code and use_nnicv:
                 # Instantiate NNICV base step, get paths from there
                 ss_step = SkullStripStep(self.project, t1_code, self.args)
                 nnicv_path = ss_step.final_icv_mask
                 t2_path = ss_step.t2_path
-                status = DTIRepo().get_nnicv_status(self.project, t1_code)
+                status = self.repo.get_nnicv_status(self.project, t1_code)
                 # Running
                 if os.path.isfile(nnicv_path) and status != 'Fail':
 
@@ -573,7 +881,7 @@ _
 
                     self.logger.info('Warping T2 to average b0')
                     t2_reg, tmap = dti_func.sym_diff_registration(
-                        dat, t2, aff, taff)
+                        dat, t2, aff, taff, **self._registration_params())
                     self.logger.info('Applying transform to NNICV mask')
                     mask = tmap.transform(nnicv, interpolation='nearest')
                     self._save_nii(t2_reg, aff, self.t2_reg)
@@ -603,6 +911,7 @@ _
                     self.final_mask):
                 if qc_func.masks_are_same(self.auto_mask, self.final_mask):
                     self._save_nii(mask, aff, self.auto_mask)
+                    _ARTIFACTS.wait(self.auto_mask)
                     shutil.copyfile(self.auto_mask, self.final_mask)
                 else:
                     self.outcome = 'Error'
@@ -612,32 +921,36 @@ _
 
             elif not os.path.isfile(self.auto_mask):
                 self._save_nii(mask, aff, self.auto_mask)
+                _ARTIFACTS.wait(self.auto_mask)
                 shutil.copyfile(self.auto_mask, self.final_mask)
 
         except FileNotFoundError:
             self.next_step = None
 
+        self._wait_for_writes()
+
     def reset(self):
         os.remove(self.final_mask)
 
     @classmethod
     def get_queue(cls, project_name):
 
-        if DTIRepo().get_project_settings(project_name)['UseNNICV']:
-            staged = DTIRepo().get_staged_cases(project_name)
-            nnicv = DTIRepo().get_finished_nnicv(project_name)
-            staged_nnicv = DTIRepo().get_staged_nnicv(project_name)
-            finished_mask_qc = DTIRepo().get_finished_mask_qc(project_name)
-            failed_masks = DTIRepo().get_failed_mask(project_name)
+        db = get_repo()
+        if db.get_project_settings(project_name)['UseNNICV']:
+            staged = db.get_staged_cases(project_name)
+            t1s = db.get_t1s(project_name)
+            nnicv = {row["Code"]
+                     for row in db.get_finished_nnicv(project_name)}
+            masked = {row["Code"] for row in itertools.chain(
+                db.get_staged_nnicv(project_name),
+                db.get_finished_mask_qc(project_name),
+                db.get_failed_mask(project_name))}
 
             todo = [
                 {'ProjectName': project_name, "Code": row["Code"]}
                 for row in staged
-                if {'Code': str(
-                    DTIRepo().get_t1(project_name, row["Code"]))} in nnicv
-                and row not in staged_nnicv
-                and row not in finished_mask_qc
-                and row not in failed_masks
+                if str(t1s.get(row["Code"])) in nnicv
+                and row["Code"] not in masked
             ]
 
             return todo
@@ -664,42 +977,30 @@ class MaskQC(BaseQCStep):
 
     @classmethod
     def get_next(cls, project_name, args):
-        cases = DTIRepo().get_masks_to_qc(project_name)
-        unfinished_nnicv = DTIRepo().get_unfinished_nnicv(project_name)
-        finished_mask_qc = DTIRepo().get_finished_mask_qc(project_name)
-
-        if DTIRepo().get_project_settings(project_name)['UseNNICV']:
-            cases = [
-                x["Code"] for x in cases
-                if DTIRepo().get_t1(project_name, x["Code"])
-                not in unfinished_nnicv
-                and x["Code"] not in finished_mask_qc
-            ]
-        else:
-            cases = [
-                x["Code"] for x in cases if x["Code"] not in finished_mask_qc
-            ]
+        db = get_repo()
+        finished_mask_qc = {
+            row["Code"] for row in db.get_finished_mask_qc(project_name)}
+        cases = [row["Code"] for row in db.get_masks_to_qc(project_name)
+                 if row["Code"] not in finished_mask_qc]
+
+        if db.get_project_settings(project_name)['UseNNICV']:
+            # Wait for the QC of the NNICV mask of the case's T1
+            t1s = db.get_t1s(project_name)
+            unfinished_nnicv = {
+                row["Code"] for row in db.get_unfinished_nnicv(project_name)}
+            cases = [code for code in cases
+                     if t1s.get(code) not in unfinished_nnicv]
 
         LOGGER.info("%s cases in queue." % len(cases))
 
-        last_job = DTIRepo().find_where_left_off(project_name, 'MaskQC')
-
-        while len(cases) != 0:
-            if (last_job
-                    and last_job['Outcome'] == 'Cancelled'
-                    and last_job['Comments'] != 'skipped'):
-                code = last_job["Code"]
-                if code in cases:
-                    cases.remove(code)
-                next_job = MaskQC(project_name, code, args)
-            else:
-                code = random.choice(cases)
-                if code in cases:
-                    cases.remove(code)
-                next_job = MaskQC(project_name, code, args)
+        last_job = db.find_where_left_off(project_name, 'MaskQC')
+        resume = None
+        if (last_job
+                and last_job['Outcome'] == 'Cancelled'
+                and last_job['Comments'] != 'skipped'):
+            resume = last_job["Code"]
 
-            if not next_job.under_review():
-                return next_job
+        return cls.next_case(project_name, args, cases, resume)
 
 
 class ApplyMask(DTIStep):
@@ -723,8 +1024,8 @@ class ApplyMask(DTIStep):
         """
         try:
             # Loading
-            reg, reg_aff = self._load_nii(self.reg)
-            mask, mask_aff = self._load_nii(self.final_mask)
+            reg, reg_aff = self._load_nii(self.reg, dtype=np.float32)
+            mask, mask_aff = self._load_nii(self.final_mask, dtype=np.uint8)
 
             # Running
             self.logger.info('Applying the mask')
@@ -736,6 +1037,8 @@ class ApplyMask(DTIStep):
         except FileNotFoundError:
             self.next_step = None
 
+        self._wait_for_writes()
+
 
 class TensorFit(DTIStep):
     """Fit the diffusion tensor model."""
@@ -757,18 +1060,24 @@ class TensorFit(DTIStep):
         ndarrays that can be saved as Nifti images. They are used to
         calculate the various measures of anisotropy. The `tenfit` object
         already generates these measures (as ndarrays), and they are also
-        saved as Nifti images.
+        saved as Nifti images. The tensor is only fitted inside the final
+        mask, the background of the outputs is zero. With the
+        `tensor_storage` setting 'sparse' or 'primary', `evals` and `evecs`
+        are instead saved for the masked voxels only, see
+        `dti_func.save_tensor`.
 
         """
         try:
             # Loading
-            dat, aff = self._load_nii(self.masked)
+            dat, aff = self._load_nii(self.masked, dtype=np.float32)
+            mask, mask_aff = self._load_nii(self.final_mask, dtype=np.uint8)
             bval, bvec = self._load_bval_bvec(self.fbval, self.fbvec)
             bvec_reg = np.loadtxt(self.fbvec_reg, delimiter=",")
 
             # Running
             self.logger.info('Fitting the tensor')
-            evals, evecs, tenfit = dti_func.fit_dti(dat, bval, bvec_reg)
+            evals, evecs, tenfit = dti_func.fit_dti(
+                dat, bval, bvec_reg, mask=mask > 0)
 
             # Saving
             self._save_nii(tenfit.fa, aff, self.fa)
@@ -776,14 +1085,22 @@ class TensorFit(DTIStep):
             self._save_nii(tenfit.ga, aff, self.ga)
             self._save_nii(tenfit.ad, aff, self.ad)
             self._save_nii(tenfit.rd, aff, self.rd)
-            self._save_nii(evals, aff, self.evals)
-            self._save_nii(evecs, aff, self.evecs)
+            storage = get_setting('tensor_storage', 'nifti')
+            if storage == 'nifti':
+                self._save_nii(evals, aff, self.evals)
+                self._save_nii(evecs, aff, self.evecs)
+            else:
+                self.logger.info(f"saving {self.tensor.split('/')[-1]}")
+                dti_func.save_tensor(self.tensor, evals, evecs, mask > 0, aff,
+                                     primary_only=storage == 'primary')
 
         except FileNotFoundError:
             self.next_step = None
         except IOError:
             self.next_step = None
 
+        self._wait_for_writes()
+
 
 class Warp(DTIStep):
     """Warp the template FA and template Labels to the subject space."""
@@ -810,27 +1127,153 @@ class Warp(DTIStep):
         try:
             # Loading
             fa, fa_aff = self._load_nii(self.fa)
-            template, template_aff = self._load_nii(self.template)
-            temp_labels, temp_labels_aff = self._load_nii(self.template_labels)
+            template, template_aff = _load_template(self.template)
+            temp_labels, temp_labels_aff = _load_template(
+                self.template_labels)
 
             # Runnning
             self.logger.info('Warping template to FA')
             warped_template, mapping = dti_func.sym_diff_registration(
                 fa, template,
-                fa_aff, template_aff)
+                fa_aff, template_aff, **self._registration_params())
             warped_labels = mapping.transform(
                 temp_labels, interpolation='nearest')
             warped_fa = mapping.transform_inverse(fa)
 
             # Saving
-            with open(self.warp_map, "wb") as f:
-                pickle.dump(mapping, f)
+            dti_func.save_mapping(mapping, self.warp_map)
             self._save_nii(warped_fa, template_aff, self.warped_fa)
             self._save_nii(warped_labels, fa_aff, self.warped_labels)
 
-        except FileNotFoundError:
+        except FileNotFoundError as e:
+            # A missing template, `_load_nii` reports the other images
+            self.outcome = 'Error'
+            self.comments = str(e)
             self.next_step = None
 
+        self._wait_for_writes()
+
+    @classmethod
+    def run_batch(cls, project, codes, workers=None, argv=()):
+        """Warp many cases on a pool of processes.
+
+        The template and its labels are loaded once and put in shared
+        memory, which every worker reads instead of loading its own copy.
+        Each case runs through the pijp engine as `dti.py -p project -s warp
+        -c code` would: its outcome is written to ProcessingLog and the
+        following steps run unless `--nocontinue` is given.
+
+        Args:
+            project (str): The name of the project.
+            codes (list): The codes of the cases.
+            workers (int): Number of processes, `workers` setting if None.
+            argv (list): More command line arguments for the engine.
+
+        Returns:
+            outcomes (dict): The (outcome, comments) logged for each code.
+
+        """
+        workers = workers or get_setting('workers', 2)
+        blocks = []
+        try:
+            shared = {}
+            for fname in [TEMPLATE, TEMPLATE_LABELS]:
+                dat, aff = _load_template(fname)
+                block = shared_memory.SharedMemory(
+                    create=True, size=max(dat.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(dat.shape, dat.dtype, buffer=block.buf)[:] = dat
+                shared[fname] = (block.name, dat.shape, dat.dtype.str, aff)
+
+            outcomes = {}
+            with futures.ProcessPoolExecutor(
+                    workers, initializer=_attach_templates,
+                    initargs=(shared,)) as pool:
+                tasks = [(cls, project, code, list(argv)) for code in codes]
+                for code, result in zip(codes, pool.map(_run_case, tasks)):
+                    outcomes[code] = result
+                    outcome, comments = result
+                    LOGGER.info(f"{code}: {outcome} {comments or ''}")
+            return outcomes
+
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+
+def _load_template(fname):
+    """Load a template image once per process.
+
+    The template is reloaded when its file changes. Templates shared by
+    `Warp.run_batch` are used as they are.
+
+    Args:
+        fname (str): Path to the template.
+
+    Returns:
+        dat (ndarray): The read only image data.
+        aff (ndarray): 4 X 4 affine of the image.
+
+    """
+    loaded = _TEMPLATES.get(fname)
+    if loaded is not None and loaded[2] is None:
+        return loaded[:2]
+
+    stat = os.stat(fname)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if loaded is None or loaded[2] != stamp:
+        LOGGER.info('loading {}'.format(fname.split('/')[-1]))
+        img = nib.as_closest_canonical(nib.load(fname))
+        dat = np.array(img.dataobj)
+        dat.flags.writeable = False
+        _TEMPLATES[fname] = (dat, img.affine, stamp)
+    return _TEMPLATES[fname][:2]
+
+
+def _attach_templates(shared):
+    """Use the templates in shared memory, see `Warp.run_batch`."""
+    for fname, (name, shape, dtype, aff) in shared.items():
+        block = shared_memory.SharedMemory(name=name)
+        dat = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        dat.flags.writeable = False
+        # No file stamp, the template is not reloaded from its file
+        _TEMPLATES[fname] = (dat, aff, None)
+        _SHARED_BLOCKS.append(block)  # The array needs its block open
+
+
+def _run_case(task):
+    """Run a step for one case of a batch through the pijp engine.
+
+    Args:
+        task (tuple): The step class, project, code and more command line
+                      arguments for the engine.
+
+    Returns:
+        outcome (str): The outcome the engine logged for this run.
+        comments (str): The comments the engine logged for this run.
+
+    """
+    step_class, project, code, argv = task
+    sys.argv[1:] = ['-p', project, '-s', step_class.step_cli,
+                    '-c', code] + argv
+    # Rows logged by earlier runs of the case are older
+    started = datetime.datetime.now().replace(microsecond=0)
+    try:
+        run_module(sys.modules[__name__])
+    except SystemExit:
+        pass
+    except Exception as e:
+        return 'Error', str(e)
+    finally:
+        _ARTIFACTS.clear()
+
+    logged = get_repo().get_step_outcome(
+        project, code, step_class.step_name, since=started)
+    if logged is None:
+        return 'Error', "The engine logged no outcome for this run"
+    return logged['Outcome'], logged['Comments']
+
 
 class Segment(DTIStep):
     """Segment the tissue for the average b0 volume."""
@@ -853,14 +1296,15 @@ class Segment(DTIStep):
         try:
             # Loading
             b0, baff = self._load_nii(self.b0)
-            mask, faff = self._load_nii(self.final_mask)
-            warped, waff = self._load_nii(self.warped_labels)
+            mask, faff = self._load_nii(self.final_mask, dtype=np.uint8)
+            warped, waff = self._load_nii(self.warped_labels, dtype=np.int16)
 
             # Running
             self.logger.info(
                 'Segmenting tissue for the masked volume')
             masked_b0 = dti_func.apply_mask(b0, mask)
 
+            _ARTIFACTS.wait(self.t2_reg)
             if os.path.isfile(self.t2_reg):
                 t2_reg, taff = self._load_nii(self.t2_reg)
                 masked_t2 = dti_func.apply_mask(t2_reg, mask)
@@ -881,6 +1325,8 @@ class Segment(DTIStep):
         except FileNotFoundError:
             self.next_step = None
 
+        self._wait_for_writes()
+
 
 class RoiStats(DTIStep):
     """Generate CSV files for DTI statistics."""
@@ -891,6 +1337,8 @@ class RoiStats(DTIStep):
 
     def __init__(self, project, code, args):
         super(RoiStats, self).__init__(project, code, args)
+        if get_setting('compress_intermediates', True) == 'end':
+            self.next_step = Compress
 
     def run(self):
         """Runs the step `RoiStats`
@@ -898,8 +1346,9 @@ class RoiStats(DTIStep):
         Loads the various measures of anisotropy, the white matter segmented
         labels, and the lookup table for the labels. The  ROI statistics
         are only calculated inside the label mask and where value of measure
-        is not zero. The statistics are saved as separate CSVs for each
-        measure.
+        is not zero. The measures are stacked so the labels are only grouped
+        once for all of them. The statistics are saved as separate CSVs for
+        each measure.
 
         """
         try:
@@ -909,9 +1358,11 @@ class RoiStats(DTIStep):
             ga, aff = self._load_nii(self.ga)
             ad, aff = self._load_nii(self.ad)
             rd, aff = self._load_nii(self.rd)
-            warped_wm_labels, aff = self._load_nii(self.warped_wm_labels)
+            warped_wm_labels, aff = self._load_nii(
+                self.warped_wm_labels, dtype=np.int16)
             # dict of int values and ROI names
             roi_labels = np.load(self.labels_lookup).item()
+            _ARTIFACTS.wait(self.fdwi)
             original = nib.load(self.fdwi)
             zooms = original.header.get_zooms()  # Returns voxel size
 
@@ -923,9 +1374,10 @@ class RoiStats(DTIStep):
                         'rd': [rd, self.rd_roi]}
 
             self.logger.info('Calculating roi statistics')
-            for idx in measures.values():
-                stats = dti_func.roi_stats(
-                    idx[0], warped_wm_labels, roi_labels, zooms)
+            dats = np.stack([idx[0] for idx in measures.values()], axis=-1)
+            tables = dti_func.roi_stats_stack(
+                dats, warped_wm_labels, roi_labels, zooms)
+            for idx, stats in zip(measures.values(), tables):
                 self._write_array(stats, idx[1])
 
         except FileNotFoundError:
@@ -939,6 +1391,40 @@ class RoiStats(DTIStep):
         self.logger.info("saving {}".format(csv_path))
 
 
+class Compress(DTIStep):
+    """Compress the uncompressed intermediate images."""
+    process_name = PROCESS_TITLE
+    step_name = "Compress"
+    step_cli = "compress"
+    prev_step = [RoiStats]
+
+    def __init__(self, project, code, args):
+        super(Compress, self).__init__(project, code, args)
+
+    def run(self):
+        """Runs the step `Compress`
+
+        Gzips the denoised, registered and masked DWIs that were saved
+        uncompressed, and removes the uncompressed files. Nothing after
+        RoiStats reads them.
+
+        """
+        _ARTIFACTS.wait()
+        for fname in [self.denoised, self.reg, self.masked]:
+            if fname.endswith('.nii') and os.path.isfile(fname):
+                self.logger.info(f"compressing {fname.split('/')[-1]}")
+                # The '.gz' is read instead of the '.nii' once it exists,
+                # so it only appears complete
+                tmp = fname + '.gz.tmp'
+                with open(fname, 'rb') as f_in:
+                    with pgzip.GzipWriter(
+                            tmp, get_setting('gzip_level', 1),
+                            self.gzip_threads) as f_out:
+                        shutil.copyfileobj(f_in, f_out)
+                os.replace(tmp, fname + '.gz')
+                os.remove(fname)
+
+
 class SegQC(BaseQCStep):
     """Launch a GUI to QC the segmentation."""
     process_name = PROCESS_TITLE
@@ -959,16 +1445,11 @@ class SegQC(BaseQCStep):
 
     @classmethod
     def get_next(cls, project_name, args):
-        cases = DTIRepo().get_segs_to_qc(project_name)
+        cases = get_repo().get_segs_to_qc(project_name)
         LOGGER.info("%s cases in queue." % len(cases))
 
-        cases = [x["Code"] for x in cases]
-        while len(cases) != 0:
-            code = random.choice(cases)
-            cases.remove(code)
-            next_job = SegQC(project_name, code, args)
-            if not next_job.under_review():
-                return next_job
+        return cls.next_case(
+            project_name, args, [row["Code"] for row in cases])
 
 
 class WarpQC(BaseQCStep):
@@ -1000,7 +1481,7 @@ class StoreInDatabase(DTIStep):
     def __init__(self, project, code, args):
         super(StoreInDatabase, self).__init__(project, code, args)
 
-        if DTIRepo().get_project_settings(self.project)['SaveMNI']:
+        if self.repo.get_project_settings(self.project)['SaveMNI']:
             self.next_step = SaveInMNI
         else:
             self.next_step = None
@@ -1013,15 +1494,15 @@ class StoreInDatabase(DTIStep):
         """
 
         self.logger.info("Storing in database")
-        proj_id = DTIRepo().get_project_id(self.project)
+        proj_id = self.repo.get_project_id(self.project)
 
         try:
-            if DTIRepo().check_seg_qc_pass(
+            if self.repo.check_seg_qc_pass(
                     self.project, self.code) == 'Pass':
-                if DTIRepo().check_warp_qc_pass(
+                if self.repo.check_warp_qc_pass(
                         self.project, self.code) == 'Pass':
 
-                    DTIRepo().set_roi_stats(proj_id, self.code, self.md_roi,
+                    self.repo.set_roi_stats(proj_id, self.code, self.md_roi,
                                             self.fa_roi, self.ga_roi,
                                             self.rd_roi, self.ad_roi)
 
@@ -1041,7 +1522,7 @@ class StoreInDatabase(DTIStep):
 
     def reset(self):
         self.logger.info("Removing {} from database".format(self.code))
-        DTIRepo().remove_roi_stats(self.project, self.code)
+        self.repo.remove_roi_stats(self.project, self.code)
 
 
 class SaveInMNI(DTIStep):
@@ -1054,42 +1535,107 @@ class SaveInMNI(DTIStep):
         super(SaveInMNI, self).__init__(project, code, args)
 
     def run(self):
+        """Runs the step `SaveInMNI`
+
+        The FA in MNI space is the inverse warped FA saved by Warp. The
+        other measures are stacked and warped together, so the sampling
+        coordinates are only computed once. All of them are saved with the
+        template's affine.
+
+        """
         try:
             # Loading
-            fa, aff = self._load_nii(self.fa)
-            md, aff = self._load_nii(self.md)
-            ga, aff = self._load_nii(self.ga)
-            rd, aff = self._load_nii(self.rd)
-            ad, aff = self._load_nii(self.ad)
-            with open(self.warp_map, "rb") as f:
-                mapping = pickle.load(f)
+            fa_warp, fa_aff = self._load_nii(self.warped_fa,
+                                             dtype=np.float32)
+            md, aff = self._load_nii(self.md, dtype=np.float32)
+            ga, aff = self._load_nii(self.ga, dtype=np.float32)
+            rd, aff = self._load_nii(self.rd, dtype=np.float32)
+            ad, aff = self._load_nii(self.ad, dtype=np.float32)
+            if os.path.isfile(self.warp_map):
+                mapping = dti_func.load_mapping(
+                    self.warp_map, inverse_only=True)
+            else:
+                # Cases warped before the map was saved as '.npz'
+                with open(self.warp_map[:-len('.npz')] + '.p', "rb") as f:
+                    mapping = pickle.load(f)
 
             # Running
             self.logger.info("Warping to MNI space")
-            fa_warp = mapping.transform_inverse(fa)
-            md_warp = mapping.transform_inverse(md)
-            ga_warp = mapping.transform_inverse(ga)
-            rd_warp = mapping.transform_inverse(rd)
-            ad_warp = mapping.transform_inverse(ad)
-
-            # Saving
-            self._save_nii(fa_warp, aff, self.fa_warp)
-            self._save_nii(md_warp, aff, self.md_warp)
-            self._save_nii(ga_warp, aff, self.ga_warp)
-            self._save_nii(rd_warp, aff, self.rd_warp)
-            self._save_nii(ad_warp, aff, self.ad_warp)
+            warped = dti_func.transform_inverse_stack(
+                mapping, np.stack([md, ga, rd, ad], axis=-1))
+            md_warp, ga_warp, rd_warp, ad_warp = [
+                warped[..., i] for i in range(0, warped.shape[-1])]
+
+            # Saving on the template grid, like the inverse warped FA
+            self._save_nii(fa_warp, fa_aff, self.fa_warp)
+            self._save_nii(md_warp, fa_aff, self.md_warp)
+            self._save_nii(ga_warp, fa_aff, self.ga_warp)
+            self._save_nii(rd_warp, fa_aff, self.rd_warp)
+            self._save_nii(ad_warp, fa_aff, self.ad_warp)
 
         except FileNotFoundError as e:
             self.outcome = 'Fail'
             self.comments = str(e)
             self.next_step = None
 
+        self._wait_for_writes()
+
+
+def parse_options(argv):
+    """Take the options of this process out of a command line.
+
+    Args:
+        argv (list): The command line arguments, without the program name.
+
+    Returns:
+        options (Namespace): The options of this process.
+        argv (list): The arguments left for the pijp engine.
+
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--registration-profile',
+                        choices=list(dti_func.REGISTRATION_PROFILES))
+    parser.add_argument('--batch', nargs='+', metavar='CODE')
+    parser.add_argument('--workers', type=int)
+    options, argv = parser.parse_known_args(argv)
+    if options.registration_profile:
+        os.environ[PROFILE_VARIABLE] = options.registration_profile
+    return options, argv
+
+
+def run_batch(codes, workers, argv):
+    """Warp the codes of the `--batch` option with `Warp.run_batch`.
+
+    Args:
+        codes (list): The codes of the cases.
+        workers (int): Number of processes, `workers` setting if None.
+        argv (list): The arguments left for the pijp engine.
+
+    Returns:
+        outcomes (dict): The (outcome, comments) logged for each code.
+
+    """
+    parser = argparse.ArgumentParser(prog='dti.py --batch')
+    parser.add_argument('-p', dest='project', required=True)
+    parser.add_argument('-s', dest='step', choices=[Warp.step_cli],
+                        default=Warp.step_cli)
+    options, argv = parser.parse_known_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    return Warp.run_batch(options.project, codes, workers, argv)
+
 
 def run():
-    import sys
-    current_module = sys.modules[__name__]
-    run_module(current_module)
+    options, sys.argv[1:] = parse_options(sys.argv[1:])
+    if options.batch:
+        run_batch(options.batch, options.workers, sys.argv[1:])
+    else:
+        current_module = sys.modules[__name__]
+        run_module(current_module)
 
 
 if __name__ == "__main__":
-    run_file(os.path.abspath(__file__))
+    options, sys.argv[1:] = parse_options(sys.argv[1:])
+    if options.batch:
+        run_batch(options.batch, options.workers, sys.argv[1:])
+    else:
+        run_file(os.path.abspath(__file__))
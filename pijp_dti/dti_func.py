@@ -1,4 +1,7 @@
+from concurrent import futures
+
 import numpy as np
+from scipy import ndimage
 from dipy.align import (imaffine, imwarp, transforms, metrics)
 from dipy.core import gradients
 from dipy.denoise import noise_estimate, non_local_means
@@ -10,6 +13,52 @@ from dipy.segment.tissue import TissueClassifierHMRF
 
 from pijp_nnicv.nifti_io import fill_holes, extract_largest_component, rescale
 
+# Read-only arrays shared with the tasks of a worker pool, see `_pool`
+_SHARED = {}
+
+# Minimum thickness of a Local PCA slab in overlaps, see `_slabs`. Thinner
+# slabs spend most of their time denoising their neighbours' slices.
+SLAB_OVERLAPS = 4
+
+# Registration parameters trading speed for accuracy, see
+# `registration_params`. `sampling_prop` is the percentage of voxels
+# sampled by mutual information and `tolerance` the optimizer's gradient
+# tolerance (None for the dipy default). `diff_level_iters` are the
+# iterations of the diffeomorphic registration.
+REGISTRATION_PROFILES = {
+    'fast': {
+        'nbins': 32,
+        'sampling_prop': 15,
+        'level_iters': [1000, 100, 20],
+        'sigmas': [3.0, 1.0, 0.0],
+        'factors': [4, 2, 1],
+        'tolerance': 1e-3,
+        'diff_level_iters': [50, 50, 10],
+    },
+    'default': {
+        'nbins': 32,
+        'sampling_prop': 100,
+        'level_iters': [10000, 1000, 100],
+        'sigmas': [3.0, 1.0, 0.0],
+        'factors': [4, 2, 1],
+        'tolerance': None,
+        'diff_level_iters': [100, 100, 30],
+    },
+    'accurate': {
+        'nbins': 64,
+        'sampling_prop': 100,
+        'level_iters': [10000, 1000, 1000],
+        'sigmas': [3.0, 1.0, 0.0],
+        'factors': [4, 2, 1],
+        'tolerance': 1e-5,
+        'diff_level_iters': [200, 100, 50],
+    },
+}
+
+# Affines of a DiffeomorphicMap kept by `save_mapping`
+_MAPPING_AFFINES = ['disp_grid2world', 'domain_grid2world',
+                    'codomain_grid2world', 'prealign']
+
 
 def mask(dat):
     """Skull strip using the Median Otsu method.
@@ -48,11 +97,16 @@ def apply_mask(dat, bin_mask):
     return otsu.applymask(dat, bin_mask)
 
 
-def denoise(dat):
+def denoise(dat, workers=1):
     """Denoise a data set using Non Local Means.
 
+    The volumes of a 4D image are denoised independently, each with its own
+    noise estimate, so they are spread over a pool of processes and written
+    straight into the output.
+
     Args:
         dat (ndarray): 3D or 4D image.
+        workers (int): Number of processes used for the denoising.
 
     Returns:
         denoise_dat (ndarray): denoised image.
@@ -62,11 +116,15 @@ def denoise(dat):
     denoise_dat = []
 
     if len(dat.shape) == 4:
-        for i in range(0, dat.shape[3]):
-            denoise_dat.append(
-                non_local_means.non_local_means(dat[..., i], sigma[i]))
+        # Non local means returns integer images as float64
+        dtype = dat.dtype if dat.dtype.kind == 'f' else np.float64
+        denoise_dat = np.empty(dat.shape, dtype=dtype)
+        volumes = (dat[..., i] for i in range(0, dat.shape[3]))
 
-        denoise_dat = np.stack(denoise_dat, axis=-1)
+        with _pool(workers, {}) as pool:
+            results = pool.map(non_local_means.non_local_means, volumes, sigma)
+            for i, denoised in enumerate(results):
+                denoise_dat[..., i] = denoised
 
     elif len(dat.shape) == 3:
         denoise_dat = non_local_means.non_local_means(dat, sigma)
@@ -74,15 +132,27 @@ def denoise(dat):
     return denoise_dat
 
 
-def denoise_pca(dat, bval, bvec):
+def denoise_pca(dat, bval, bvec, workers=1, mem=None, patch_radius=2):
     """Denoise a data set using Local PCA.
 
     Local PCA is a denoising method specific to 4D diffusion weighted images.
 
+    With more than one worker or a memory budget, the image is denoised in
+    slabs along the third axis, in a pool of processes. Each patch only
+    depends on its own voxels, so a slab that overlaps its neighbours by
+    twice the patch radius gives the same result for its own voxels as
+    denoising the whole image. The slabs stay several times thicker than
+    the overlap, and the memory budget is met by denoising fewer slabs at
+    once.
+
     Args:
         dat (ndarray): 3D or 4D image.
         bval (ndarray): 1D ndarray containing the b-values
         bvec (ndarray): 2D ndarray containing the b-vectors
+        workers (int): Number of processes used for the denoising.
+        mem (int): Memory budget in MB for the denoising, including the
+                   image, its noise estimate and the result.
+        patch_radius (int): Radius of the local PCA patches.
 
     Returns:
         denoise_dat (ndarray): The denoised ndarray
@@ -90,42 +160,128 @@ def denoise_pca(dat, bval, bvec):
     """
     gtab = gradients.gradient_table(bval, bvec)
     sigma = pca_noise_estimate(dat, gtab)
-    denoise_dat = localpca(dat, sigma=sigma)
+
+    if workers == 1 and mem is None:
+        return localpca(dat, sigma=sigma, patch_radius=patch_radius)
+
+    overlap = 2 * patch_radius
+    slabs, workers = _slabs(dat, sigma, workers, mem, overlap)
+    denoise_dat = np.empty(dat.shape, dtype=dat.dtype)
+    tasks = ((dat[:, :, start:stop], sigma[:, :, start:stop])
+             for start, stop, core in slabs)
+
+    with _pool(workers, {'patch_radius': patch_radius}) as pool:
+        results = pool.map(_denoise_pca_slab, tasks)
+        for (start, stop, core), slab in zip(slabs, results):
+            denoise_dat[:, :, start + core[0]:start + core[1]] = \
+                slab[:, :, core[0]:core[1]]
+
     return denoise_dat
 
 
-def average_b0(dat, aff, bval):
+def _slabs(dat, sigma, workers, mem, overlap):
+    """Split the third axis into overlapping slabs within a memory budget.
+
+    Local PCA holds about four float64 copies of the data it denoises, and
+    this process holds the data, its noise estimate and the result. Slabs
+    are at least `SLAB_OVERLAPS` times as thick as the overlap. When the
+    budget is too small for a slab per worker, fewer workers are used, with
+    slabs as thick as the budget allows. A budget too small for one slab of
+    the minimum thickness denoises one such slab at a time.
+
+    Returns:
+        slabs (list): (start, stop, core) of each slab, where `core` is the
+                      (start, stop) of the voxels it keeps, relative to the
+                      start of the slab.
+        workers (int): Number of slabs to denoise at once.
+
+    """
+    nslices = dat.shape[2]
+    min_size = min(SLAB_OVERLAPS * overlap, nslices)
+    size = max(-(-nslices // workers), min_size)
+    if mem is not None:
+        slice_mem = 4 * 8 * dat[:, :, 0].size
+        free = mem * 2 ** 20 - 2 * dat.nbytes - sigma.nbytes
+        workers = max(
+            min(workers, free // ((size + 2 * overlap) * slice_mem)), 1)
+        # The fewer workers, the thicker their slabs can be
+        size = max(min(-(-nslices // workers),
+                       free // (workers * slice_mem) - 2 * overlap), min_size)
+
+    slabs = []
+    for first in range(0, nslices, size):
+        last = min(first + size, nslices)
+        start = max(first - overlap, 0)
+        stop = min(last + overlap, nslices)
+        slabs.append((start, stop, (first - start, last - start)))
+
+    return slabs, int(min(workers, len(slabs)))
+
+
+def _denoise_pca_slab(task):
+    dat, sigma = task
+    return localpca(dat, sigma=sigma, patch_radius=_SHARED['patch_radius'])
+
+
+def average_b0(dat, aff, bval, return_reg=False, profile='default',
+               **params):
     """Obtain the average b0 image from a 4D DWI image.
 
+    Every b0 after the first is rigidly registered to the first b0, which
+    is used as it is.
+
     Args:
         dat (ndarray): 4D diffusion weighted image.
         aff (ndarray): 4 X 4 affine of the image.
         bval (ndarray): 1D ndarray containing the b-values
+        return_reg (bool): Also return the registered b0 volumes.
+        profile (str): The registration profile, see `registration_params`.
+        **params: Registration parameters overriding the profile.
 
     Returns:
         b0 (ndarray): 3D averaged b0 image.
+        b0_reg (dict): Only if `return_reg`. The (registered volume, affine)
+                       of each b0, keyed by its index in the DWI.
 
     """
     b0 = None
-    b0s_reg = []
+    b0_reg = {}
 
     for i in range(0, len(bval)):
         if bval[i] == 0:
             if b0 is None:
                 b0 = dat[..., i]
-            b0_reg, b0_aff, b0_map = affine_registration(
-                b0, dat[..., i], aff, aff, rigid=True)
-            b0s_reg.append(b0_reg)
-
-    b0s_reg = np.stack(b0s_reg, axis=-1)
+                b0_reg[i] = (np.asarray(b0, dtype=float), np.eye(4))
+            else:
+                reg_vol, reg_aff, reg_map = affine_registration(
+                    b0, dat[..., i], aff, aff, rigid=True, profile=profile,
+                    **params)
+                b0_reg[i] = (reg_vol, reg_aff)
+
+    b0s_reg = np.stack([reg[0] for reg in b0_reg.values()], axis=-1)
     b0_avg = np.mean(b0s_reg, axis=-1)
 
+    if return_reg:
+        return b0_avg, b0_reg
     return b0_avg
 
 
-def register(b0, dwi, b0_aff, aff, bval, bvec):
+def register(b0, dwi, b0_aff, aff, bval, bvec, workers=1, b0_reg=None,
+             warm_start=False, profile='default', **params):
     """Rigidly register a 4D DWI to its own 3D b0 image.
 
+    The volumes are independent of each other, so with more than one worker
+    they are registered in a pool of processes. The b0 is handed to each
+    worker once when it starts instead of with every volume.
+
+    The average b0 is in the space of the first b0, so the registrations
+    from `average_b0` already align the b0 volumes to it. Volumes given in
+    `b0_reg` reuse those transforms and are not optimized again.
+
+    Head motion between consecutive volumes is small. With `warm_start`,
+    each worker gets one run of consecutive volumes and starts each
+    optimization from the transform found for the volume before it.
+
     Args:
         b0 (ndarray): 3D average b0 image.
         dwi (ndarray): 4D DWI image
@@ -133,26 +289,54 @@ def register(b0, dwi, b0_aff, aff, bval, bvec):
         aff (ndarray): 4 X 4 affine matrix for the DWI
         bval (ndarray): 1D ndarray containing the b-values
         bvec (ndarray): 2D ndarray containing the b-vectors
+        workers (int): Number of processes used for the registration.
+        b0_reg (dict): The registered b0 volumes returned by `average_b0`.
+        warm_start (bool): Seed each volume with the previous transform.
+        profile (str): The registration profile, see `registration_params`.
+        **params: Registration parameters overriding the profile.
 
     Returns:
         reg_dat (ndarray): 4D ndarray of the registered DWI
         reg_bvecs (ndarray): 2D ndarray of the updated b-vectors
+        reg_map (ndarray): 4 X 4 X N stack of the registration affines
 
     """
-    affines = []
-    reg_map = []
-    reg_dat = []
-
-    for i in range(0, dwi.shape[3]):
-        reg_dir, reg_aff, reg_map_slice = affine_registration(
-            b0, dwi[..., i], b0_aff, aff, rigid=True)
-        reg_dat.append(reg_dir)
-        reg_map.append(reg_map_slice.affine)
-        if bval[i] != 0: # Only want to update b-vectors with non-zero b-values
-            affines.append(reg_aff)
-
-    reg_dat = np.stack(reg_dat, axis=-1)
-    reg_map = np.stack(reg_map, axis=-1)
+    nvols = dwi.shape[3]
+    reg_dat = np.empty(b0.shape + (nvols,),
+                       dtype=np.result_type(dwi.dtype, np.float32))
+    reg_map = np.empty((4, 4, nvols))
+    b0_reg = b0_reg or {}
+
+    for i, (reg_vol, reg_aff) in b0_reg.items():
+        reg_dat[..., i] = reg_vol
+        reg_map[..., i] = reg_aff
+
+    todo = [i for i in range(0, nvols) if i not in b0_reg]
+
+    # A task registers one run of consecutive volumes. When warm starting,
+    # each worker gets one run and chains the transforms inside it.
+    runs = [[i] for i in todo]
+    if warm_start and todo:
+        size = -(-len(todo) // workers)
+        runs = [todo[j:j + size] for j in range(0, len(todo), size)]
+    # Views of the DWI, the tasks waiting to be sent are not copies. A run
+    # skips the b0 volumes between its first and last volume.
+    tasks = ((dwi[..., run[0]:run[-1] + 1], [i - run[0] for i in run])
+             for run in runs)
+
+    shared = {'static': b0, 'static_affine': b0_aff, 'moving_affine': aff,
+              'warm_start': warm_start,
+              'params': registration_params(profile, **params)}
+    with _pool(workers, shared) as pool:
+        # map keeps the runs in their original order
+        results = pool.map(_register_run, tasks)
+        for run, run_results in zip(runs, results):
+            for i, (reg_vol, reg_aff) in zip(run, run_results):
+                reg_dat[..., i] = reg_vol
+                reg_map[..., i] = reg_aff
+
+    # Only want to update b-vectors with non-zero b-values
+    affines = [reg_map[..., i] for i in range(0, nvols) if bval[i] != 0]
     gtab = gradients.gradient_table(bval, bvec)
     new_gtab = gradients.reorient_bvecs(gtab, affines)
     reg_bvecs = new_gtab.bvecs
@@ -160,13 +344,70 @@ def register(b0, dwi, b0_aff, aff, bval, bvec):
     return reg_dat, reg_bvecs, reg_map
 
 
-def fit_dti(dat, bval, bvec):
+def _pool(workers, shared):
+    """Get a pool of worker processes that share some read-only arrays.
+
+    The shared arrays are sent to each process once when it starts, rather
+    than with every task. A single worker runs the tasks in this process.
+
+    Args:
+        workers (int): Number of processes.
+        shared (dict): Arrays the tasks read from `_SHARED`.
+
+    Returns:
+        pool (Executor): The executor to map the tasks with.
+
+    """
+    if workers > 1:
+        return futures.ProcessPoolExecutor(
+            workers, initializer=_share, initargs=(shared,))
+
+    _share(shared)
+    return _SerialExecutor()
+
+
+def _share(shared):
+    _SHARED.update(shared)
+
+
+class _SerialExecutor(futures.Executor):
+    """Executor that maps tasks in the calling process."""
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        return map(fn, *iterables)
+
+    def shutdown(self, wait=True, **kwargs):
+        _SHARED.clear()
+
+
+def _register_run(task):
+    volumes, indices = task
+    # Every run starts from the centers of mass, not from another task
+    starting_affine = 'mass'
+    results = []
+    for i in indices:
+        dat_reg, affine, aff_map = affine_registration(
+            _SHARED['static'], volumes[..., i], _SHARED['static_affine'],
+            _SHARED['moving_affine'], rigid=True,
+            starting_affine=starting_affine, **_SHARED['params'])
+        if _SHARED['warm_start']:  # The next volume of the run starts here
+            starting_affine = affine
+        results.append((dat_reg, affine))
+    return results
+
+
+def fit_dti(dat, bval, bvec, mask=None):
     """Fit the tensor using the Weighted Least Squares fit method.
 
+    Only the voxels inside the mask are fitted. The outputs keep the full
+    size of the image and are zero outside the mask.
+
     Args:
         dat (ndarray): 4D diffusion weighted image.
         bval (ndarray): 1D ndarray containing the b-values
         bvec (ndarray): 2D ndarray containing the b-vectors
+        mask (ndarray): 3D boolean mask of the voxels to fit, or None to
+                        fit every voxel.
 
     Returns:
         evals (ndarray): 4D ndarray of the eigenvalues
@@ -176,13 +417,67 @@ def fit_dti(dat, bval, bvec):
     """
     gtab = gradients.gradient_table(bval, bvec)
     tenmodel = dti.TensorModel(gtab)
-    tenfit = tenmodel.fit(dat)
+    tenfit = tenmodel.fit(dat, mask=mask)
     evals = tenfit.evals
     evecs = tenfit.evecs
 
     return evals, evecs, tenfit
 
 
+def save_tensor(fname, evals, evecs, mask, affine, primary_only=False):
+    """Save the eigenvalues and eigenvectors of the voxels inside a mask.
+
+    The values are stored as float32 in a compressed '.npz' file, with the
+    flat indices of the mask's voxels and the shape and affine of the image.
+
+    Args:
+        fname (str): Path of the '.npz' file.
+        evals (ndarray): 4D ndarray of the eigenvalues
+        evecs (ndarray): 5D ndarray of the eigenvectors
+        mask (ndarray): 3D boolean mask of the fitted voxels.
+        affine (ndarray): 4 X 4 affine matrix of the image.
+        primary_only (bool): Only keep the primary eigenvector.
+
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if primary_only:
+        evecs = evecs[..., 0]  # The eigenvectors are the columns
+    with open(fname, 'wb') as f:
+        np.savez_compressed(
+            f, shape=mask.shape, affine=affine,
+            index=np.flatnonzero(mask).astype(np.uint32),
+            evals=evals[mask].astype(np.float32),
+            evecs=evecs[mask].astype(np.float32))
+
+
+def load_tensor(fname):
+    """Load the eigenvalues and eigenvectors saved by `save_tensor`.
+
+    Args:
+        fname (str): Path of the '.npz' file.
+
+    Returns:
+        evals (ndarray): 4D float32 ndarray of the eigenvalues
+        evecs (ndarray): 5D float32 ndarray of the eigenvectors, or 4D
+                         ndarray of the primary eigenvector.
+        affine (ndarray): 4 X 4 affine matrix of the image.
+
+    """
+    with np.load(fname) as f:
+        shape = tuple(f['shape'])
+        index = f['index']
+        arrays = []
+        for name in ['evals', 'evecs']:
+            sparse = f[name]
+            dense = np.zeros((np.prod(shape),) + sparse.shape[1:],
+                             dtype=sparse.dtype)
+            dense[index] = sparse
+            arrays.append(dense.reshape(shape + sparse.shape[1:]))
+        affine = f['affine']
+
+    return arrays[0], arrays[1], affine
+
+
 def segment_tissue(dat):
     """Segments the image into different tissue classifications
 
@@ -217,9 +512,9 @@ def apply_tissue_mask(dat, segmented, tissue=1, prob=50):
     """
     tissue_mask = segmented[..., tissue]
     threshold = (prob/100)
-    dat[tissue_mask < threshold] = 0
 
-    return dat
+    return np.where(tissue_mask < threshold, 0, dat).astype(
+        dat.dtype, copy=False)
 
 
 def roi_stats(dat, overlay, labels, zooms):
@@ -235,34 +530,137 @@ def roi_stats(dat, overlay, labels, zooms):
         stats (list): Array of the list of stats for all regions of interests.
 
     """
-    roi_voxels = dict()
-    stats = [['name', 'min', 'max', 'mean', 'sd', 'median', 'volume']]
+    return roi_stats_stack(dat[..., np.newaxis], overlay, labels, zooms)[0]
+
+
+def roi_stats_stack(dats, overlay, labels, zooms):
+    """Get roi statistics for a stack of diffusion tensor measures at once.
+
+    The voxels are grouped by roi once for the whole stack. The labelled,
+    non-zero values are then sorted by (measure, roi, value) together, so the
+    min, max and median of every roi are read from its sorted run and the
+    mean and standard deviation come from bincount sums.
+
+    Args:
+        dats (ndarray): 4D stack of measures, the 4th dimension is the measure.
+        overlay (ndarray): 3D label image.
+        labels (Union): A dictionary of overlay values as keys that correspond
+                        to region labels_lookup as dictionary values.
+        zooms (list): list of voxel dimensions
+    Returns:
+        stats (list): One roi_stats table for each measure in the stack.
+
+    """
     vox_size = zooms[0] * zooms[1] * zooms[2]  # The size of voxels in mm
-    for roi_labels in labels.values():
-        roi_voxels[roi_labels] = []  # A dynamic list for each of the ROI's
-
-    for coord, val in np.ndenumerate(dat):
-        key = overlay[coord]  # Get the integer value from the overlay image
-        if key in labels:  # Find the label name for that integer value
-            roi_name = labels[key]
-            if val != 0:
-                roi_voxels[roi_name].append(val)
-
-    for rois in roi_voxels.keys():
-        npa = np.asarray(roi_voxels[rois])
-        try:
+    roi_names, voxels, rois = _group_rois(overlay, labels)
+    nrois = len(roi_names)
+    nmeasures = dats.shape[-1]
+    ngroups = nrois * nmeasures
+
+    # Every (measure, roi) pair is its own group, only non-zero values count
+    vals = dats.reshape(-1, nmeasures)[voxels].ravel()
+    groups = (rois[:, np.newaxis] + np.arange(nmeasures) * nrois).ravel()
+    nonzero = vals != 0
+    groups, vals = groups[nonzero], vals[nonzero]
+
+    order = np.lexsort((vals, groups))
+    groups, vals = groups[order], vals[order]
+
+    counts = np.bincount(groups, minlength=ngroups)
+    found = counts > 0
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    mean = np.zeros(ngroups)
+    mean[found] = np.bincount(groups, vals, ngroups)[found] / counts[found]
+    sq_dev = np.bincount(groups, (vals - mean[groups]) ** 2, ngroups)
+    sd = np.zeros(ngroups)
+    sd[found] = np.sqrt(sq_dev[found] / counts[found])
+
+    # The median averages the two middle values of even sized rois
+    lower = starts + (counts - 1) // 2
+    upper = starts + counts // 2
+    min_val = np.zeros(ngroups)
+    max_val = np.zeros(ngroups)
+    median = np.zeros(ngroups)
+    min_val[found] = vals[starts[found]]
+    max_val[found] = vals[ends[found] - 1]
+    median[found] = (vals[lower[found]] + vals[upper[found]]) / 2
+    volume = counts * vox_size
+
+    tables = []
+    for m in range(nmeasures):
+        stats = [['name', 'min', 'max', 'mean', 'sd', 'median', 'volume']]
+        for i, name in enumerate(roi_names, start=m * nrois):
             # Name, Min, Max, Mean, Std. Dev, Median, Volume
-            stats.append([rois, npa.min(), npa.max(), npa.mean(),
-                          npa.std(), np.median(npa), (len(npa)*vox_size)])
+            stats.append([name, min_val[i], max_val[i], mean[i],
+                          sd[i], median[i], volume[i]])
+        tables.append(stats)
+
+    return tables
 
-        except ValueError:  # Catches rows with empty ROIs
-            stats.append([rois, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
 
-    return stats
+def _group_rois(overlay, labels):
+    """Find the roi of every labelled voxel in the overlay.
+
+    Overlay values that share a region name are pooled into one roi.
+
+    Args:
+        overlay (ndarray): 3D label image.
+        labels (Union): A dictionary of overlay values as keys that correspond
+                        to region labels_lookup as dictionary values.
+
+    Returns:
+        roi_names (list): The region names in lookup order.
+        voxels (ndarray): Flat indices of the labelled voxels.
+        rois (ndarray): The index into `roi_names` for each voxel.
+
+    """
+    roi_names = list(dict.fromkeys(labels.values()))
+    roi_index = {name: i for i, name in enumerate(roi_names)}
+    keys = np.array(list(labels.keys()))
+    key_rois = np.array([roi_index[name] for name in labels.values()])
+    order = np.argsort(keys)
+    keys, key_rois = keys[order], key_rois[order]
+
+    overlay = np.ravel(overlay)
+    pos = np.searchsorted(keys, overlay).clip(0, len(keys) - 1)
+    voxels = np.flatnonzero(keys[pos] == overlay)
+
+    return roi_names, voxels, key_rois[pos[voxels]]
+
+
+def registration_params(profile='default', **params):
+    """Get the parameters of a registration profile.
+
+    The profiles in `REGISTRATION_PROFILES` are 'fast', 'default' and
+    'accurate'. Any of their parameters can be overridden individually.
+
+    Args:
+        profile (str): The name of the profile.
+        **params: Parameters overriding those of the profile.
+
+    Returns:
+        params (dict): The registration parameters.
+
+    """
+    if profile not in REGISTRATION_PROFILES:
+        raise ValueError(f"Unknown registration profile '{profile}'. "
+                         f"Use one of {list(REGISTRATION_PROFILES)}.")
+
+    unknown = set(params) - set(REGISTRATION_PROFILES[profile])
+    if unknown:
+        raise ValueError(f"Unknown registration parameters {unknown}.")
+
+    profile_params = dict(REGISTRATION_PROFILES[profile])
+    profile_params.update(params)
+
+    return profile_params
 
 
 def affine_registration(static, moving,
-                        static_affine, moving_affine, rigid=False):
+                        static_affine, moving_affine, rigid=False,
+                        starting_affine='mass', profile='default', **params):
     """Register one 3D array to another using linear registration.
 
     Args:
@@ -271,6 +669,11 @@ def affine_registration(static, moving,
         static_affine (ndarray): 4 X 4 affine matrix of the static image.
         moving_affine (ndarray): 4 X 4 affine matrix of the moving image.
         rigid (bool): A flag for rigid registration
+        starting_affine (Union): 4 X 4 affine to start the optimization
+                                 from, or 'mass' to align the image's
+                                 centers of mass.
+        profile (str): The registration profile, see `registration_params`.
+        **params: Registration parameters overriding the profile.
 
     Returns:
 
@@ -278,17 +681,24 @@ def affine_registration(static, moving,
         affine (ndarray): 4 X 4 transformation matrix
 
     """
+    params = registration_params(profile, **params)
+
     # Mutual information Metric
-    nbins = 32  # Number of bins for computing the histograms
-    sampling_prop = 100  # percentage of voxels (0, 100]
-    metric = imaffine.MutualInformationMetric(nbins, sampling_prop)
-    level_iters = [10000, 1000, 100]  # coarse to fine
-    sigmas = [3.0, 1.0, 0.0]
-    factors = [4, 2, 1]  # Factors that determine resolution
+    nbins = params['nbins']  # Number of bins for computing the histograms
+    sampling_prop = params['sampling_prop']  # percentage of voxels (0, 100]
+    # dipy takes the sampled proportion of voxels (0, 1]
+    metric = imaffine.MutualInformationMetric(nbins, sampling_prop / 100)
+    level_iters = params['level_iters']  # coarse to fine
+    sigmas = params['sigmas']
+    factors = params['factors']  # Factors that determine resolution
+
+    options = None
+    if params['tolerance'] is not None:
+        options = {'gtol': params['tolerance'], 'disp': False}
 
     affreg = imaffine.AffineRegistration(
         metric, level_iters=level_iters, sigmas=sigmas,
-        factors=factors, verbosity=0)
+        factors=factors, options=options, verbosity=0)
     params0 = None
 
     if rigid:
@@ -299,13 +709,14 @@ def affine_registration(static, moving,
     # 'mass' tells optimize to align the image's centers of mass
     aff_map = affreg.optimize(static, moving,
                               transform, params0,
-                              static_affine, moving_affine, 'mass')
+                              static_affine, moving_affine, starting_affine)
     dat_reg = aff_map.transform(moving)
 
     return dat_reg, aff_map.affine, aff_map
 
 
-def sym_diff_registration(static, moving, static_affine, moving_affine):
+def sym_diff_registration(static, moving, static_affine, moving_affine,
+                          profile='default', **params):
     """Register one 3D array to another using non-linear registration.
 
     Args:
@@ -313,17 +724,20 @@ def sym_diff_registration(static, moving, static_affine, moving_affine):
         moving (ndarray): 3D image to register
         static_affine (ndarray): 4 X 4 affine matrix of the static image.
         moving_affine (ndarray): 4 X 4 affine matrix of the moving image.
+        profile (str): The registration profile, see `registration_params`.
+        **params: Registration parameters overriding the profile.
 
     Returns:
         warped_moving (ndarray): The registered moving 3D image
         mapping (DiffeomorphicMap): The mapping object
 
     """
+    params = registration_params(profile, **params)
     moving_reg, pre_align, reg_map = affine_registration(
-        static, moving, static_affine, moving_affine)
+        static, moving, static_affine, moving_affine, **params)
     metric = metrics.CCMetric(3)  # Cross Correlation Metric for 3 dimensions
-    level_iters = [100, 100, 30]  # Iterations at each resolution (fine
-    #  to coarse)
+    # Iterations at each resolution (fine to coarse)
+    level_iters = params['diff_level_iters']
 
     sdr = imwarp.SymmetricDiffeomorphicRegistration(metric, level_iters)
     sdr.verbosity = 0
@@ -332,3 +746,138 @@ def sym_diff_registration(static, moving, static_affine, moving_affine):
     warped_moving = mapping.transform(moving)
 
     return warped_moving, mapping
+
+
+def transform_inverse_stack(mapping, stack, slab=16):
+    """Warp a stack of images with the inverse of a diffeomorphic map.
+
+    Gives the same result as `mapping.transform_inverse` with linear
+    interpolation on each image of the stack, but the sampling coordinates
+    are only computed once for all of them. The output is computed in slabs
+    along the first axis to bound the memory used by the coordinates.
+
+    Args:
+        mapping (DiffeomorphicMap): The mapping object
+        stack (ndarray): 4D stack of 3D images in the mapping's codomain.
+        slab (int): Number of output slices sampled at once.
+
+    Returns:
+        warped (ndarray): 4D float32 stack of the warped images.
+
+    """
+    # The matrices dipy uses to warp, see `DiffeomorphicMap._warp_forward`
+    # and `DiffeomorphicMap._warp_backward`
+    if mapping.is_inverse:
+        field = mapping.forward
+        world2grid = mapping.codomain_world2grid
+        out_shape = mapping.domain_shape
+        out_grid2world = mapping.domain_grid2world
+        idx_in = _mult_aff(mapping.disp_world2grid, mapping.prealign,
+                           out_grid2world)
+        idx_out = _mult_aff(world2grid, mapping.prealign, out_grid2world)
+        disp = _mult_aff(world2grid)
+    else:
+        field = mapping.backward
+        world2grid = mapping.domain_world2grid
+        out_shape = mapping.codomain_shape
+        out_grid2world = mapping.codomain_grid2world
+        idx_in = _mult_aff(mapping.disp_world2grid, out_grid2world)
+        idx_out = _mult_aff(world2grid, mapping.prealign_inv, out_grid2world)
+        disp = _mult_aff(world2grid, mapping.prealign_inv)
+
+    out_shape = tuple(int(n) for n in out_shape)
+    stack = np.asarray(stack, dtype=np.float32)
+    warped = np.empty(out_shape + stack.shape[3:], dtype=np.float32)
+
+    for start in range(0, out_shape[0], slab):
+        stop = min(start + slab, out_shape[0])
+        grid = np.mgrid[start:stop, :out_shape[1], :out_shape[2]]
+        grid = grid.reshape(3, -1).astype(np.float64)
+
+        # Displacement at each output voxel
+        if np.array_equal(idx_in, np.eye(4)):
+            displacement = field[start:stop].reshape(-1, 3).T
+        else:
+            points = idx_in[:3, :3].dot(grid) + idx_in[:3, 3:]
+            displacement = np.array([
+                ndimage.map_coordinates(field[..., i], points, order=1,
+                                        mode='grid-constant')
+                for i in range(0, 3)])
+
+        # Voxel coordinates sampled in the images, zero outside like dipy
+        points = (idx_out[:3, :3].dot(grid) + idx_out[:3, 3:] +
+                  disp[:3, :3].dot(displacement))
+        for i in range(0, stack.shape[3]):
+            warped[start:stop, ..., i] = ndimage.map_coordinates(
+                stack[..., i], points, order=1, mode='grid-constant',
+            ).reshape(stop - start, out_shape[1], out_shape[2])
+
+    return warped
+
+
+def _mult_aff(*affines):
+    """Multiply affines, where None is the identity."""
+    product = np.eye(4)
+    for affine in affines:
+        if affine is not None:
+            product = product.dot(affine)
+    return product
+
+
+def save_mapping(mapping, fname):
+    """Save a diffeomorphic map as float32 displacement fields.
+
+    The fields are stored with the map's shapes and affines in an
+    uncompressed '.npz' file, so each field can be read on its own.
+
+    Args:
+        mapping (DiffeomorphicMap): The mapping object.
+        fname (str): Path of the '.npz' file.
+
+    """
+    arrays = {
+        'dim': mapping.dim,
+        'is_inverse': mapping.is_inverse,
+        'disp_shape': mapping.disp_shape,
+        'domain_shape': mapping.domain_shape,
+        'codomain_shape': mapping.codomain_shape,
+        'forward': mapping.forward.astype(np.float32, copy=False),
+        'backward': mapping.backward.astype(np.float32, copy=False),
+    }
+    for name in _MAPPING_AFFINES:
+        if getattr(mapping, name) is not None:
+            arrays[name] = getattr(mapping, name)
+
+    with open(fname, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def load_mapping(fname, inverse_only=False):
+    """Load a diffeomorphic map saved by `save_mapping`.
+
+    Args:
+        fname (str): Path of the '.npz' file.
+        inverse_only (bool): Only read the displacement field used by
+                             `transform_inverse`.
+
+    Returns:
+        mapping (DiffeomorphicMap): The mapping object
+
+    """
+    with np.load(fname) as f:
+        affines = {name: f[name] if name in f.files else None
+                   for name in _MAPPING_AFFINES}
+        mapping = imwarp.DiffeomorphicMap(
+            int(f['dim']), f['disp_shape'], affines['disp_grid2world'],
+            f['domain_shape'], affines['domain_grid2world'],
+            f['codomain_shape'], affines['codomain_grid2world'],
+            affines['prealign'])
+        mapping.is_inverse = bool(f['is_inverse'])
+
+        # An inverted map warps backwards with its forward field
+        inverse_field = 'forward' if mapping.is_inverse else 'backward'
+        for field in ['forward', 'backward']:
+            if not inverse_only or field == inverse_field:
+                setattr(mapping, field, f[field])
+
+    return mapping
@@ -0,0 +1,222 @@
+"""Block gzip reading and writing on multiple threads.
+
+The files are standard gzip files made of independent members, so gzip,
+nibabel and FSLeyes read them as usual. Each member holds one block of the
+uncompressed data and records its own compressed size in a gzip extra
+field, like BGZF does. The blocks are compressed in parallel when writing,
+and the sizes let the members be found and decompressed in parallel when
+reading.
+"""
+import gzip
+import io
+import struct
+import zlib
+from collections import deque
+from concurrent import futures
+
+import nibabel as nib
+import numpy as np
+
+
+BLOCK_SIZE = 2 ** 20  # Uncompressed bytes in each gzip member
+
+# Extra field subfield holding the member's compressed size
+_SUBFIELD = b'PZ'
+_HEADER = struct.Struct('<4BIBBHccHI')  # gzip header with the extra field
+_TRAILER = struct.Struct('<II')  # crc32 and uncompressed size
+
+
+class GzipWriter(io.RawIOBase):
+    """A write-only file object that compresses blocks on a thread pool.
+
+    Blocks are written in order, and at most a few blocks per thread are
+    held in memory at once.
+
+    Args:
+        fname (str): Path of the gzip file.
+        level (int): Compression level, 1 (fastest) to 9 (smallest).
+        threads (int): Number of compression threads.
+
+    """
+
+    def __init__(self, fname, level=1, threads=4):
+        super(GzipWriter, self).__init__()
+        self.level = level
+        self.threads = threads
+        self._file = open(fname, 'wb')
+        self._pool = futures.ThreadPoolExecutor(threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self._buffer += data
+        self._size += len(data)
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._size
+        if offset < self._size or whence == io.SEEK_END:
+            raise io.UnsupportedOperation('can only seek forwards')
+        self.write(bytes(offset - self._size))
+        return self._size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown()
+            self._file.close()
+            super(GzipWriter, self).close()
+
+    def _submit(self, block):
+        self._pending.append(
+            self._pool.submit(compress_block, block, self.level))
+        while len(self._pending) > 2 * self.threads:
+            self._file.write(self._pending.popleft().result())
+
+
+def compress_block(block, level=1):
+    """Compress a block of data into a single gzip member.
+
+    Args:
+        block (bytes): The uncompressed data.
+        level (int): Compression level, 1 (fastest) to 9 (smallest).
+
+    Returns:
+        member (bytes): The gzip member.
+
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(block) + compressor.flush()
+    member_size = _HEADER.size + len(deflated) + _TRAILER.size
+    # magic, deflate, FEXTRA flag, mtime, xfl, unknown os, extra field
+    header = _HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 255, 8,
+                          _SUBFIELD[:1], _SUBFIELD[1:], 4, member_size)
+    trailer = _TRAILER.pack(zlib.crc32(block) & 0xffffffff,
+                            len(block) & 0xffffffff)
+    return header + deflated + trailer
+
+
+def read(fname, threads=4):
+    """Decompress a block gzip file on multiple threads.
+
+    Args:
+        fname (str): Path of the gzip file.
+        threads (int): Number of decompression threads.
+
+    Returns:
+        data (bytearray): The uncompressed data, or None if the file was
+                          not written in blocks by `GzipWriter`.
+
+    Raises:
+        BadGzipFile: A member's data does not match its CRC32 or size.
+
+    """
+    with open(fname, 'rb') as f:
+        # Other gzip files are told apart by their first header alone
+        raw = f.read(_HEADER.size)
+        if _member_size(raw, 0) is None:
+            return None
+        raw += f.read()
+
+    members = []
+    offset = 0
+    while offset < len(raw):
+        member_size = _member_size(raw, offset)
+        if member_size is None or offset + member_size > len(raw):
+            return None
+        members.append((offset, member_size))
+        offset += member_size
+
+    sizes = [_TRAILER.unpack_from(raw, start + size - _TRAILER.size)[1]
+             for start, size in members]
+    data = bytearray(sum(sizes))
+    starts = np.cumsum([0] + sizes)
+
+    def decompress(i):
+        start, size = members[i]
+        block = zlib.decompress(
+            raw[start + _HEADER.size:start + size - _TRAILER.size],
+            -zlib.MAX_WBITS)
+        crc = _TRAILER.unpack_from(raw, start + size - _TRAILER.size)[0]
+        if zlib.crc32(block) != crc or len(block) != sizes[i]:
+            raise gzip.BadGzipFile(f"CRC check failed in {fname}")
+        data[starts[i]:starts[i] + len(block)] = block
+
+    with futures.ThreadPoolExecutor(threads) as pool:
+        list(pool.map(decompress, range(len(members))))
+
+    return data
+
+
+def _member_size(raw, offset):
+    """Get the size of the block gzip member at an offset, or None."""
+    if len(raw) - offset < _HEADER.size:
+        return None
+    header = _HEADER.unpack_from(raw, offset)
+    if header[:4] != (0x1f, 0x8b, 8, 4) or \
+            header[8] + header[9] != _SUBFIELD or \
+            header[-1] < _HEADER.size + _TRAILER.size:
+        return None
+    return header[-1]
+
+
+def save_nifti(img, fname, level=1, threads=4):
+    """Save a Nifti image as a block gzip file.
+
+    Args:
+        img (Nifti1Image): The image to save.
+        fname (str): Path of the '.nii.gz' file.
+        level (int): Compression level, 1 (fastest) to 9 (smallest).
+        threads (int): Number of compression threads.
+
+    """
+    with GzipWriter(fname, level, threads) as writer:
+        img.to_file_map({'image': nib.FileHolder(fileobj=writer)})
+
+
+def load_nifti(fname, threads=4):
+    """Load a Nifti image saved by `save_nifti` on multiple threads.
+
+    Args:
+        fname (str): Path of the '.nii.gz' file.
+        threads (int): Number of decompression threads.
+
+    Returns:
+        img (Nifti1Image): The image, or None if it was not saved in blocks
+                           by `save_nifti`.
+
+    """
+    data = read(fname, threads)
+    if data is None:
+        return None
+
+    hdr = nib.Nifti1Header.from_fileobj(io.BytesIO(data[:348]), check=False)
+    vox_offset = int(hdr['vox_offset'])
+    hdr = nib.Nifti1Header.from_fileobj(io.BytesIO(data[:vox_offset]))
+    dat = np.ndarray(hdr.get_data_shape(), dtype=hdr.get_data_dtype(),
+                     buffer=data, offset=vox_offset, order='F')
+
+    slope, inter = hdr.get_slope_inter()
+    if slope is not None and (slope != 1 or inter != 0):
+        dat = dat * slope + inter
+
+    return nib.Nifti1Image(dat, hdr.get_best_affine(), header=hdr)
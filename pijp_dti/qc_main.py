@@ -61,7 +61,7 @@ class QCApp(QtWidgets.QMainWindow, qc_design.Ui_MainWindow):
         else:
             self.group_button.addButton(self.button_edit)
 
-        if self.mode == 'MaskQC' and repo.DTIRepo().get_project_settings(
+        if self.mode == 'MaskQC' and repo.get_repo().get_project_settings(
                 self.project)['UseNNICV']:
             self.set_status()
 
@@ -182,7 +182,7 @@ class QCApp(QtWidgets.QMainWindow, qc_design.Ui_MainWindow):
         self.plot.update_figure(self.image, self.overlay)
 
     def set_status(self):
-        status = repo.DTIRepo().get_mask_status(self.project, self.code)
+        status = repo.get_repo().get_mask_status(self.project, self.code)
 
         if status.find("Used NNICV final mask.") != -1:
             self.label_status.setText("Status: " + status)
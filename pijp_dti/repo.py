@@ -1,5 +1,8 @@
 import csv
+import functools
 import getpass
+import os
+import time
 from datetime import datetime
 
 from pijp.dbprocs import format_string_parameter as fsp
@@ -9,6 +12,41 @@ import pijp_dti
 
 PROCESS_TITLE = pijp_dti.__process_title__
 
+# Seconds a shared connection may sit unused before it is checked again
+HEALTH_CHECK_INTERVAL = 60
+
+# The repository shared by this process, see `get_repo`
+_SHARED = {'repo': None, 'pid': None, 'used': 0.0}
+
+# Seconds a project lookup is cached for, see `cached_lookup`
+LOOKUP_TTL = 300
+
+# Cached project lookups by method and project: (expiry time, value)
+_LOOKUPS = {}
+
+
+def cached_lookup(method):
+    """Cache a slowly changing project lookup for `LOOKUP_TTL` seconds.
+
+    Results that are None are not cached, so a project added meanwhile is
+    found. Use `DTIRepo.invalidate` to drop cached results sooner.
+
+    """
+    @functools.wraps(method)
+    def lookup(self, project):
+        key = (method.__name__, project)
+        now = time.monotonic()
+        cached = _LOOKUPS.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        value = method(self, project)
+        if value is not None:
+            _LOOKUPS[key] = (now + LOOKUP_TTL, value)
+        return value
+
+    return lookup
+
 
 class DTIRepo(BaseRepository):
 
@@ -16,6 +54,12 @@ class DTIRepo(BaseRepository):
         super().__init__()
         self.connection.setdb('imaging')
 
+    def is_alive(self):
+        try:
+            return self.connection.fetchone("SELECT 1 AS Alive") is not None
+        except Exception:
+            return False
+
     def get_scancode(self, code):
         sql = r"""
         SELECT 
@@ -34,6 +78,13 @@ class DTIRepo(BaseRepository):
         if todo:
             return todo["Code"]
 
+    @staticmethod
+    def invalidate(project=None):
+        for key in list(_LOOKUPS):
+            if project is None or key[1] == project:
+                _LOOKUPS.pop(key, None)
+
+    @cached_lookup
     def get_project_id(self, project):
         sql = r"""
         SELECT ProjectID FROM Projects WHERE ProjectName = {}
@@ -46,6 +97,7 @@ class DTIRepo(BaseRepository):
 
         return project_id
 
+    @cached_lookup
     def get_project_settings(self, project):
 
         sql = r"""
@@ -62,6 +114,32 @@ class DTIRepo(BaseRepository):
 
         return todo
 
+    @cached_lookup
+    def get_registration_profile(self, project):
+
+        # Databases made before the column was added use the default profile
+        sql = r"""
+        SELECT COL_LENGTH('ProjectPijpDTI', 'RegistrationProfile') AS Length
+        """
+        column = self.connection.fetchone(sql)
+        if not column or column["Length"] is None:
+            return 'default'
+
+        sql = r"""
+        SELECT
+            RegistrationProfile
+        FROM
+            ProjectPijpDTI
+        WHERE
+            ProjectID = {proj_id}
+        """.format(proj_id=(self.get_project_id(project)))
+
+        todo = self.connection.fetchone(sql)
+        if todo and todo["RegistrationProfile"]:
+            return todo["RegistrationProfile"]
+
+        return 'default'
+
     def get_project_dtis(self, project):
 
         sql = r"""
@@ -145,39 +223,55 @@ class DTIRepo(BaseRepository):
         sql = r"""
         INSERT INTO pijp_dti (Code, ProjectID, FileName, Measure, Roi, MinVal, MaxVal, MeanVal, StdDev, MedianVal, 
                               Volume, RecordDate)
-        VALUES ({code}, {project_id}, {fname}, {measure}, {roi}, {min}, {max}, {mean}, {sd}, {median}, {vol}, {time})
+        VALUES (%s, %d, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """
+        record_date = datetime.now().replace(microsecond=0)
+        values = []
         measures = [md, fa, ga, rd, ad]
         for m in measures:
             with open(m) as csvfile:
                 mreader = csv.reader(csvfile, delimiter=',')
-                msr = fsp(m.split('_')[-2].rstrip('_roi.csv'))
+                msr = m.split('_')[-2].rstrip('_roi.csv')
+                fname = m.split('/')[-1]
                 for row in mreader:
                     if mreader.line_num == 1:
-                        row.pop()
-                    else:
-                        fname = fsp(m.split('/')[-1])
-                        roi = fsp(str(row[0]))
-                        min_val = fsp(str(row[1]))
-                        max_val = fsp(str(row[2]))
-                        mean_val = fsp(str(row[3]))
-                        sd = fsp(str(row[4]))
-                        median_val = fsp(str(row[5]))
-                        volume = fsp(str(row[6]))
-                        time = fsp(
-                            datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                        formatted_sql = sql.format(
-                            code=fsp(code), project_id=project_id, fname=fname,
-                            measure=msr, roi=roi, min=min_val, max=max_val,
-                            mean=mean_val, sd=sd, median=median_val,
-                            vol=volume, time=time)
-                        self.connection.execute_non_query(formatted_sql)
+                        continue
+                    values.append(tuple(
+                        [code, project_id, fname, msr] +
+                        [str(val) for val in row[:7]] + [record_date]))
+
+        if values:
+            self.executemany(sql, values)
+
+    def executemany(self, sql, params):
+        """Run a parameterized statement for each row of `params`.
+
+        All the rows are inserted in one transaction, which is rolled back
+        if any of them fails.
+
+        Args:
+            sql (str): The statement, with pymssql parameter placeholders.
+            params (list): A tuple of parameters for each row.
+
+        """
+        # pijp's connection only runs SQL text, its pymssql connection
+        # runs parameterized statements
+        conn = self.connection.connection
+        cursor = conn.cursor()
+        try:
+            cursor.executemany(sql, params)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
 
     def remove_roi_stats(self, project, code):
         project_id = self.get_project_id(project)
         sql = r"""
         DELETE FROM pijp_dti WHERE ProjectID = {project_id} AND Code = {code} 
-        """.format(project_id=project_id['ProjectID'], code=fsp(code))
+        """.format(project_id=project_id, code=fsp(code))
 
         self.connection.execute_non_query(sql)
 
@@ -213,6 +307,21 @@ class DTIRepo(BaseRepository):
 
         return todo
 
+    def get_t1s(self, project):
+
+        sql = r"""
+        SELECT
+            ScanCode, Code
+        FROM ImageList.{project}
+        WHERE ImageType='T1'
+        """.format(project=project)
+
+        todo = {}
+        for row in self.connection.fetchall(sql):
+            todo.setdefault(row["ScanCode"], row["Code"])
+
+        return todo
+
     def get_finished_nnicv(self, project):
 
         sql = r"""
@@ -279,6 +388,25 @@ class DTIRepo(BaseRepository):
 
         return status
 
+    def get_step_outcome(self, project, code, step, since):
+
+        sql = r"""
+        SELECT
+            Outcome, Comments
+        FROM ProcessingLog
+        WHERE Project = {project}
+            AND Process = {process}
+            AND Step = {step}
+            AND ScanCode = {code}
+            AND CompletedOn >= {since}
+        ORDER BY
+            CompletedOn DESC
+        """.format(project=fsp(project), process=fsp(PROCESS_TITLE),
+                   step=fsp(step), code=fsp(code),
+                   since=fsp(since.strftime('%Y-%m-%d %H:%M:%S')))
+
+        return self.connection.fetchone(sql)
+
     def get_unfinished_nnicv(self, project):
 
         sql = r"""
@@ -406,3 +534,27 @@ class DTIRepo(BaseRepository):
         else:
             todo = ''
         return todo
+
+
+def get_repo():
+    """Get the `DTIRepo` shared by the steps of this process.
+
+    The repository and its connection are made on first use and reused
+    afterwards. A connection unused for more than `HEALTH_CHECK_INTERVAL`
+    seconds is checked before it is handed out, and replaced when it has
+    been dropped. A child process makes its own connection rather than use
+    the one it inherited.
+
+    Returns:
+        repo (DTIRepo): The shared repository.
+
+    """
+    now = time.monotonic()
+    shared = _SHARED['repo']
+    if shared is None or _SHARED['pid'] != os.getpid() or (
+            now - _SHARED['used'] > HEALTH_CHECK_INTERVAL
+            and not shared.is_alive()):
+        _SHARED['repo'] = DTIRepo()
+        _SHARED['pid'] = os.getpid()
+    _SHARED['used'] = now
+    return _SHARED['repo']
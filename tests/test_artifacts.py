@@ -0,0 +1,87 @@
+import unittest
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from pijp_dti import artifacts
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = artifacts.ArtifactCache(budget=2 * 42 ** 3 * 8)
+
+    def tearDown(self):
+
+        self.cache.clear()
+        self.tmp.cleanup()
+
+    def _image(self):
+
+        return nib.Nifti1Image(np.random.rand(42, 42, 42), np.eye(4))
+
+    def _write(self, img, fname):
+
+        img.to_filename(fname)
+
+    def test_put_get(self):
+
+        fname = os.path.join(self.tmp.name, 'a.nii.gz')
+        img = self._image()
+        self.cache.put(fname, img, self._write)
+
+        self.assertIs(img, self.cache.get(fname))
+        self.assertFalse(img.dataobj.flags.writeable)
+        self.cache.wait(fname)
+        np.testing.assert_array_equal(
+            img.dataobj, nib.load(fname).get_fdata())
+
+    def test_budget(self):
+
+        fnames = [os.path.join(self.tmp.name, f'{i}.nii.gz')
+                  for i in range(3)]
+        for fname in fnames:
+            self.cache.put(fname, self._image(), self._write)
+
+        self.assertIsNone(self.cache.get(fnames[0]))
+        self.assertIsNotNone(self.cache.get(fnames[2]))
+        self.assertLessEqual(self.cache.nbytes, self.cache.budget)
+        self.cache.wait()
+        self.assertTrue(all(os.path.isfile(fname) for fname in fnames))
+
+    def test_no_budget(self):
+
+        self.cache.budget = 0
+        fname = os.path.join(self.tmp.name, 'a.nii.gz')
+        self.cache.put(fname, self._image(), self._write)
+
+        self.assertIsNone(self.cache.get(fname))
+        self.assertTrue(os.path.isfile(fname))
+
+    def test_write_error(self):
+
+        fname = os.path.join(self.tmp.name, 'missing', 'a.nii.gz')
+        self.cache.put(fname, self._image(), self._write)
+
+        self.assertRaises(FileNotFoundError, self.cache.wait, fname)
+
+    def test_wait_all_after_error(self):
+
+        missing = os.path.join(self.tmp.name, 'missing', 'a.nii.gz')
+        fname = os.path.join(self.tmp.name, 'b.nii.gz')
+        self.cache.put(missing, self._image(), self._write)
+        self.cache.put(fname, self._image(), self._write)
+
+        self.assertRaises(FileNotFoundError, self.cache.wait)
+        self.assertIsNone(self.cache.get(missing))
+        self.assertIsNotNone(self.cache.get(fname))
+        self.assertTrue(os.path.isfile(fname))
+        self.cache.wait()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,11 @@
 import unittest
 import os
+import sys
+import tempfile
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
 
 from pijp_dti import dti
 
@@ -127,3 +133,168 @@ class Test(unittest.TestCase):
         self.assertTrue(os.path.isfile(save_in_mni.ga_warp))
         self.assertTrue(os.path.isfile(save_in_mni.ad_warp))
         self.assertTrue(os.path.isfile(save_in_mni.rd_warp))
+
+
+class ReviewStep(dti.BaseQCStep):
+    """A QC step that only knows its review flag."""
+
+    made = []
+
+    def __init__(self, project, code, args):
+        self.code = code
+        self.logger = dti.LOGGER
+        self.review_flag = os.path.join(
+            dti.get_process_dir(project), code, dti.REVIEW_FLAG)
+        self.made.append(code)
+
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(dti, 'get_process_dir',
+                                  lambda project: self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        ReviewStep.made = []
+
+    def _flag(self, code):
+
+        os.makedirs(os.path.join(self.tmp.name, code))
+        with open(os.path.join(self.tmp.name, code, dti.REVIEW_FLAG),
+                  'w') as f:
+            f.write("someone\n2020-01-01\n")
+
+    def test_next_case_skips_flagged(self):
+
+        self._flag('a')
+        self._flag('b')
+        step = ReviewStep.next_case('p', None, ['a', 'b', 'c'])
+
+        self.assertEqual('c', step.code)
+        self.assertEqual(['c'], ReviewStep.made)
+        self.assertIsNone(ReviewStep.next_case('p', None, ['a', 'b']))
+
+    def test_next_case_resume(self):
+
+        self.assertEqual(
+            'b', ReviewStep.next_case('p', None, ['a', 'b'], 'b').code)
+
+        self._flag('b')
+        self.assertEqual(
+            'a', ReviewStep.next_case('p', None, ['a', 'b'], 'b').code)
+        self.assertIsNone(ReviewStep.next_case('p', None, [], 'c'))
+
+    def test_next_case_flagged_since(self):
+
+        self._flag('a')
+        with mock.patch.object(ReviewStep, 'under_review_codes',
+                               return_value=set()):
+            step = ReviewStep.next_case('p', None, ['a', 'b'])
+
+        self.assertEqual('b', step.code)
+
+    def test_mask_queue(self):
+
+        db = mock.Mock()
+        db.get_project_settings.return_value = {'UseNNICV': True}
+        db.get_staged_cases.return_value = [
+            {'Code': code} for code in ['a', 'b', 'c', 'd', 'e']]
+        db.get_t1s.return_value = {'a': 1, 'b': 2, 'c': 3, 'd': 4}
+        db.get_finished_nnicv.return_value = [
+            {'Code': code} for code in ['1', '2', '3', '4']]
+        db.get_staged_nnicv.return_value = [{'Code': 'b'}]
+        db.get_finished_mask_qc.return_value = [{'Code': 'c'}]
+        db.get_failed_mask.return_value = [{'Code': 'd'}]
+
+        with mock.patch.object(dti, 'get_repo', return_value=db):
+            todo = dti.Mask.get_queue('p')
+
+        self.assertEqual([{'ProjectName': 'p', 'Code': 'a'}], todo)
+
+
+class Logged(object):
+    """Answers with the outcome a fake engine run logged in this process."""
+
+    rows = {}
+
+    def get_step_outcome(self, project, code, step, since):
+        return self.rows.get((project, code, step))
+
+
+def run_engine(module):
+    """Log the command line and whether the templates were shared."""
+    argv = sys.argv[1:]
+    shared = all(dti._TEMPLATES.get(fname, ())[2:] == (None,)
+                 for fname in [dti.TEMPLATE, dti.TEMPLATE_LABELS])
+    Logged.rows[(argv[1], argv[5], 'Warp')] = {
+        'Outcome': 'Done', 'Comments': ' '.join(argv + [str(shared)])}
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        Logged.rows = {}
+        patches = [mock.patch.object(dti, 'get_repo', Logged),
+                   mock.patch.object(dti, 'run_module', run_engine),
+                   mock.patch.dict(dti._TEMPLATES, clear=True)]
+        for name in ['TEMPLATE', 'TEMPLATE_LABELS']:
+            fname = os.path.join(self.tmp.name, name + '.nii')
+            nib.save(nib.Nifti1Image(np.zeros((4, 5, 6), np.float32),
+                                     np.eye(4)), fname)
+            patches.append(mock.patch.object(dti, name, fname))
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_run_batch(self):
+
+        outcomes = dti.Warp.run_batch('p', ['a', 'b'], 2, ['--nocontinue'])
+
+        self.assertEqual({
+            'a': ('Done', '-p p -s warp -c a --nocontinue True'),
+            'b': ('Done', '-p p -s warp -c b --nocontinue True')}, outcomes)
+
+    def test_run_case(self):
+
+        task = (dti.Warp, 'p', 'a', [])
+        self.assertEqual(('Done', '-p p -s warp -c a False'),
+                         dti._run_case(task))
+
+    def test_run_case_nothing_logged(self):
+
+        task = (dti.Warp, 'p', 'a', [])
+        with mock.patch.object(dti, 'run_module', lambda module: None):
+            self.assertEqual('Error', dti._run_case(task)[0])
+
+        with mock.patch.object(dti, 'run_module',
+                               side_effect=RuntimeError('no engine')):
+            self.assertEqual(('Error', 'no engine'), dti._run_case(task))
+
+
+class ProfileTest(unittest.TestCase):
+
+    def _params(self, profile):
+
+        step = dti.Warp.__new__(dti.Warp)
+        step.project = 'p'
+        step.logger = dti.LOGGER
+        db = mock.Mock()
+        db.get_registration_profile.return_value = profile
+        with mock.patch.object(dti, 'get_repo', return_value=db), \
+                mock.patch.dict(os.environ, clear=False) as environ:
+            environ.pop(dti.PROFILE_VARIABLE, None)
+            return step._registration_params()
+
+    def test_unknown_profile(self):
+
+        with self.assertLogs(dti.LOGGER, 'WARNING'):
+            params = self._params('fsat')
+        self.assertEqual(dti.dti_func.registration_params('default'), params)
+        self.assertEqual(dti.dti_func.registration_params('fast'),
+                         self._params('fast'))
@@ -1,5 +1,10 @@
 import unittest
+import os
+import tempfile
+from unittest import mock
+
 import numpy as np
+from dipy.align import imwarp
 
 from pijp_dti import dti_func
 
@@ -28,6 +33,14 @@ class Test(unittest.TestCase):
 
         self.assertEqual(dat.shape, denoised.shape)
 
+    def test_denoise_workers(self):
+
+        dat = np.random.rand(16, 16, 16, 4)
+        denoised = dti_func.denoise(dat)
+        parallel = dti_func.denoise(dat, workers=2)
+
+        np.testing.assert_array_equal(denoised, parallel)
+
     def test_denoise_pca(self):
 
         dat = np.random.rand(42, 42, 42, 42)
@@ -37,6 +50,36 @@ class Test(unittest.TestCase):
 
         self.assertEqual(dat.shape, denoised.shape)
 
+    def test_denoise_pca_slabs(self):
+
+        dat = np.random.rand(20, 20, 30, 12)
+        bval = np.zeros(12)
+        bvec = np.random.rand(12, 3)
+        denoised = dti_func.denoise_pca(dat, bval, bvec)
+        tiled = dti_func.denoise_pca(dat, bval, bvec, workers=2, mem=1)
+
+        np.testing.assert_array_equal(denoised, tiled)
+
+    def test_slabs_budget(self):
+
+        dat = np.empty((96, 96, 60, 120), dtype=np.float32)
+        sigma = np.empty(dat.shape[:3])
+        slabs, workers = dti_func._slabs(dat, sigma, 16, 1024, 4)
+
+        self.assertEqual(1, workers)
+        self.assertEqual(4, len(slabs))
+        self.assertEqual(list(range(60)), [
+            start + i for start, stop, core in slabs
+            for i in range(*core)])
+
+        slabs, workers = dti_func._slabs(dat, sigma, 16, 2048, 4)
+        self.assertEqual((1, 2), (workers, len(slabs)))
+
+        slabs, workers = dti_func._slabs(dat, sigma, 16, 8192, 4)
+        self.assertEqual((4, 4), (workers, len(slabs)))
+        for start, stop, core in slabs[:-1]:
+            self.assertEqual(16, core[1] - core[0])
+
     def test_average_b0(self):
 
         dat = np.random.rand(42, 42, 42, 42)
@@ -60,6 +103,92 @@ class Test(unittest.TestCase):
         self.assertEqual(dat.shape, reg_dat.shape)
         self.assertEqual(bvec.shape, reg_bvec.shape)
 
+    def test_register_workers(self):
+
+        dat = np.random.rand(24, 24, 24, 4)
+        b0 = dat[..., 0]
+        aff = np.eye(4)
+        bval = np.array([0, 1000, 1000, 1000])
+        bvec = np.random.rand(4, 3)
+        bvec /= np.linalg.norm(bvec, axis=1)[:, np.newaxis]
+
+        serial = dti_func.register(b0, dat, aff, aff, bval, bvec)
+        parallel = dti_func.register(b0, dat, aff, aff, bval, bvec, workers=2)
+
+        for expected, actual in zip(serial, parallel):
+            np.testing.assert_allclose(expected, actual)
+
+    def test_register_b0_reg(self):
+
+        dat = np.random.rand(24, 24, 24, 4)
+        aff = np.eye(4)
+        bval = np.array([0, 1000, 0, 1000])
+        bvec = np.random.rand(4, 3)
+        bvec /= np.linalg.norm(bvec, axis=1)[:, np.newaxis]
+
+        b0, b0_reg = dti_func.average_b0(dat, aff, bval, return_reg=True)
+        reg_dat, reg_bvec, reg_map = dti_func.register(
+            b0, dat, aff, aff, bval, bvec, b0_reg=b0_reg)
+
+        self.assertEqual([0, 2], sorted(b0_reg))
+        np.testing.assert_array_equal(dat[..., 0], reg_dat[..., 0])
+        np.testing.assert_array_equal(np.eye(4), reg_map[..., 0])
+        np.testing.assert_array_equal(b0_reg[2][0], reg_dat[..., 2])
+        np.testing.assert_array_equal(b0_reg[2][1], reg_map[..., 2])
+
+    def test_register_warm_start(self):
+
+        x, y, z = np.mgrid[:24, :24, :24].astype(float)
+        b0 = (np.exp(-((x - 12) ** 2 / 40 + (y - 11) ** 2 / 15
+                       + (z - 10) ** 2 / 5))
+              + np.exp(-((x - 6) ** 2 + (y - 16) ** 2 + (z - 13) ** 2) / 4))
+        dat = np.stack([b0] * 4, axis=-1)
+        aff = np.eye(4)
+        bval = np.array([0, 1000, 1000, 1000])
+        bvec = np.random.rand(4, 3)
+        bvec /= np.linalg.norm(bvec, axis=1)[:, np.newaxis]
+
+        reg_dat, reg_bvec, reg_map = dti_func.register(
+            b0, dat, aff, aff, bval, bvec, workers=2, warm_start=True,
+            tolerance=1e-3)
+
+        self.assertEqual(dat.shape, reg_dat.shape)
+        for i in range(0, 4):
+            np.testing.assert_allclose(np.eye(4), reg_map[..., i], atol=0.05)
+
+    def test_register_run_starts_from_mass(self):
+
+        starts = []
+        moved = []
+
+        def affine_registration(static, moving, *args, starting_affine,
+                                **kwargs):
+            starts.append(starting_affine)
+            moved.append(moving)
+            return moving, np.full((4, 4), len(starts)), None
+
+        dat = np.random.rand(8, 8, 8, 3)
+        dti_func._share({'static': dat[..., 0], 'static_affine': np.eye(4),
+                         'moving_affine': np.eye(4), 'warm_start': True,
+                         'params': {}})
+        try:
+            with mock.patch.object(dti_func, 'affine_registration',
+                                   affine_registration):
+                first = dti_func._register_run((dat, [0, 1, 2]))
+                second = dti_func._register_run((dat[..., :1], [0]))
+                skipped = dti_func._register_run((dat, [0, 2]))
+        finally:
+            dti_func._SHARED.clear()
+
+        self.assertEqual(3, len(first))
+        self.assertEqual(1, len(second))
+        self.assertEqual('mass', starts[0])
+        np.testing.assert_array_equal(first[0][1], starts[1])
+        np.testing.assert_array_equal(first[1][1], starts[2])
+        self.assertEqual('mass', starts[3])
+        self.assertEqual(2, len(skipped))
+        np.testing.assert_array_equal(dat[..., 2], moved[-1])
+
     def test_fit_dti(self):
         dat = np.random.rand(42, 42, 42, 42)
         bval = np.zeros(42)
@@ -71,6 +200,46 @@ class Test(unittest.TestCase):
         self.assertEqual(dat[..., 0].shape + (3,), evals.shape)  # should have 3 eigenvalues per voxel for 3D image
         self.assertEqual(dat[..., 0].shape + (3, 3), evecs.shape)  # should have 3 eigenvectors per voxel for 3D image
 
+    def test_fit_dti_mask(self):
+        dat = np.random.rand(16, 16, 16, 12)
+        bval = np.array([0] + [1000] * 11)
+        bvec = np.random.rand(12, 3)
+        bvec /= np.linalg.norm(bvec, axis=1)[:, np.newaxis]
+        mask = np.zeros(dat.shape[:3], dtype=bool)
+        mask[4:12, 4:12, 4:12] = True
+
+        evals, evecs, tenfit = dti_func.fit_dti(dat, bval, bvec)
+        masked_evals, masked_evecs, masked_tenfit = dti_func.fit_dti(
+            dat, bval, bvec, mask=mask)
+
+        self.assertEqual(evals.shape, masked_evals.shape)
+        self.assertEqual(evecs.shape, masked_evecs.shape)
+        np.testing.assert_allclose(evals[mask], masked_evals[mask])
+        self.assertFalse(masked_evals[~mask].any())
+        self.assertFalse(masked_tenfit.fa[~mask].any())
+
+    def test_save_load_tensor(self):
+        evals = np.random.rand(8, 9, 10, 3)
+        evecs = np.random.rand(8, 9, 10, 3, 3)
+        mask = np.random.rand(8, 9, 10) > 0.5
+        evals[~mask] = 0
+        evecs[~mask] = 0
+        aff = np.diag([2.0, 2.0, 2.0, 1.0])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'tensor.npz')
+            dti_func.save_tensor(fname, evals, evecs, mask, aff)
+            loaded_evals, loaded_evecs, loaded_aff = dti_func.load_tensor(
+                fname)
+            dti_func.save_tensor(fname, evals, evecs, mask, aff,
+                                 primary_only=True)
+            primary_evals, primary, primary_aff = dti_func.load_tensor(fname)
+
+        np.testing.assert_allclose(evals, loaded_evals, rtol=1e-6)
+        np.testing.assert_allclose(evecs, loaded_evecs, rtol=1e-6)
+        np.testing.assert_array_equal(aff, loaded_aff)
+        np.testing.assert_allclose(evecs[..., 0], primary, rtol=1e-6)
+
     def test_segment_tissue(self):
 
         dat = np.random.rand(42, 42, 42)
@@ -88,6 +257,45 @@ class Test(unittest.TestCase):
 
         self.assertEqual(dat.shape, segmented_dat.shape)
 
+    def test_roi_stats(self):
+
+        dat = np.random.rand(42, 42, 42)
+        dat[dat < 0.2] = 0
+        overlay = np.random.randint(0, 4, size=(42, 42, 42))
+        labels = {1: 'roi_1', 2: 'roi_2', 3: 'roi_3', 4: 'roi_4'}
+        zooms = (1.0, 1.0, 2.0)
+
+        stats = dti_func.roi_stats(dat, overlay, labels, zooms)
+
+        self.assertEqual(len(labels) + 1, len(stats))
+        for row in stats[1:4]:
+            npa = dat[(overlay == int(row[0][-1])) & (dat != 0)]
+            np.testing.assert_allclose(
+                row[1:], [npa.min(), npa.max(), npa.mean(), npa.std(),
+                          np.median(npa), len(npa) * 2.0])
+        self.assertEqual(['roi_4', 0, 0, 0, 0, 0, 0], stats[-1])
+
+    def test_roi_stats_stack(self):
+
+        dats = np.random.rand(42, 42, 42, 5)
+        dats[dats < 0.2] = 0
+        overlay = np.random.randint(0, 4, size=(42, 42, 42))
+        labels = {1: 'roi_1', 2: 'roi_2', 3: 'roi_3', 4: 'roi_4'}
+        zooms = (1.0, 1.0, 2.0)
+
+        tables = dti_func.roi_stats_stack(dats, overlay, labels, zooms)
+
+        self.assertEqual(dats.shape[-1], len(tables))
+        for i, stats in enumerate(tables):
+            dat = dats[..., i]
+            self.assertEqual(len(labels) + 1, len(stats))
+            for row in stats[1:4]:
+                npa = dat[(overlay == int(row[0][-1])) & (dat != 0)]
+                np.testing.assert_allclose(
+                    row[1:], [npa.min(), npa.max(), npa.mean(), npa.std(),
+                              np.median(npa), len(npa) * 2.0])
+            self.assertEqual(['roi_4', 0, 0, 0, 0, 0, 0], stats[-1])
+
     def test_affine_registration(self):
 
         static = np.random.rand(42, 42, 42)
@@ -99,6 +307,67 @@ class Test(unittest.TestCase):
 
         self.assertEqual(static.shape, reg.shape)
 
+    def test_save_load_mapping(self):
+
+        mapping = imwarp.DiffeomorphicMap(
+            3, (16, 16, 16), np.eye(4), prealign=np.diag([1.0, 1.0, 2.0, 1.0]))
+        mapping.forward = np.random.rand(16, 16, 16, 3).astype(np.float32)
+        mapping.backward = np.random.rand(16, 16, 16, 3).astype(np.float32)
+        mapping.is_inverse = True
+        dat = np.random.rand(16, 16, 16)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'warp_map.npz')
+            dti_func.save_mapping(mapping, fname)
+            loaded = dti_func.load_mapping(fname)
+            inverse = dti_func.load_mapping(fname, inverse_only=True)
+
+        np.testing.assert_array_equal(mapping.backward, loaded.backward)
+        self.assertIsNone(inverse.backward)
+        np.testing.assert_allclose(
+            mapping.transform(dat), loaded.transform(dat), atol=1e-5)
+        np.testing.assert_allclose(
+            mapping.transform_inverse(dat), inverse.transform_inverse(dat),
+            atol=1e-5)
+
+    def test_transform_inverse_stack(self):
+
+        disp_aff = np.diag([2.0, 2.0, 2.0, 1.0])
+        codomain_aff = np.diag([3.0, 3.0, 2.5, 1.0])
+        prealign = np.eye(4)
+        prealign[:3, 3] = [1.5, -2.0, 0.5]
+        mapping = imwarp.DiffeomorphicMap(
+            3, (12, 14, 10), disp_aff, (24, 28, 20), np.eye(4),
+            (10, 10, 12), codomain_aff, prealign)
+        mapping.forward = np.random.rand(12, 14, 10, 3).astype(np.float32)
+        mapping.backward = np.random.rand(12, 14, 10, 3).astype(np.float32)
+
+        for is_inverse in [True, False]:
+            mapping.is_inverse = is_inverse
+            if is_inverse:
+                stack = np.random.rand(10, 10, 12, 3)
+            else:
+                stack = np.random.rand(24, 28, 20, 3)
+
+            warped = dti_func.transform_inverse_stack(mapping, stack, slab=5)
+
+            for i in range(0, 3):
+                np.testing.assert_allclose(
+                    mapping.transform_inverse(stack[..., i]),
+                    warped[..., i], atol=1e-5)
+
+    def test_registration_params(self):
+
+        params = dti_func.registration_params('fast', sampling_prop=10)
+
+        self.assertEqual(10, params['sampling_prop'])
+        self.assertEqual(
+            dti_func.REGISTRATION_PROFILES['fast']['level_iters'],
+            params['level_iters'])
+        self.assertRaises(ValueError, dti_func.registration_params, 'slow')
+        self.assertRaises(ValueError, dti_func.registration_params,
+                          'default', bins=16)
+
     # FIXME: This has a div by 0 error
     # def test_sym_diff_registration(self):
     #
@@ -0,0 +1,101 @@
+import unittest
+import gzip
+import io
+import os
+import tempfile
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
+
+from pijp_dti import pgzip
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmp.name, 'test.nii.gz')
+
+    def tearDown(self):
+
+        self.tmp.cleanup()
+
+    def test_gzip_writer(self):
+
+        data = os.urandom(pgzip.BLOCK_SIZE * 2 + 100)
+        with pgzip.GzipWriter(self.fname, threads=2) as f:
+            f.write(data[:10])
+            f.write(data[10:])
+
+        with gzip.open(self.fname, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual(data, pgzip.read(self.fname, threads=2))
+
+    def test_read_plain_gzip(self):
+
+        with gzip.open(self.fname, 'wb') as f:
+            f.write(b'plain')
+
+        self.assertIsNone(pgzip.read(self.fname))
+        self.assertIsNone(pgzip.load_nifti(self.fname))
+
+    def test_read_plain_gzip_header_only(self):
+
+        with gzip.open(self.fname, 'wb') as f:
+            f.write(os.urandom(10000))
+
+        class File(io.FileIO):
+            nread = 0
+
+            def read(self, size=-1):
+                data = super(File, self).read(size)
+                File.nread += len(data)
+                return data
+
+        with mock.patch.object(pgzip, 'open', File, create=True):
+            self.assertIsNone(pgzip.read(self.fname))
+        self.assertEqual(pgzip._HEADER.size, File.nread)
+
+    def test_read_truncated(self):
+
+        with pgzip.GzipWriter(self.fname) as f:
+            f.write(os.urandom(pgzip.BLOCK_SIZE + 100))
+        with open(self.fname, 'r+b') as f:
+            f.truncate(os.path.getsize(self.fname) - 10)
+
+        self.assertIsNone(pgzip.read(self.fname))
+
+    def test_read_corrupted(self):
+
+        with pgzip.GzipWriter(self.fname) as f:
+            f.write(os.urandom(pgzip.BLOCK_SIZE + 100))
+        with open(self.fname, 'rb') as f:
+            raw = bytearray(f.read())
+
+        # Random data is stored, so a flipped byte still inflates
+        for offset in [pgzip._HEADER.size + 1000, len(raw) - 8]:
+            raw[offset] ^= 0xff
+            with open(self.fname, 'wb') as f:
+                f.write(raw)
+            with self.assertRaises(gzip.BadGzipFile):
+                pgzip.read(self.fname)
+            raw[offset] ^= 0xff
+
+    def test_save_load_nifti(self):
+
+        dat = np.random.rand(42, 42, 42, 3).astype(np.float32)
+        aff = np.diag([2.0, 2.0, 2.0, 1.0])
+        pgzip.save_nifti(nib.Nifti1Image(dat, aff), self.fname, threads=2)
+
+        img = nib.load(self.fname)
+        np.testing.assert_array_equal(dat, img.get_fdata(dtype=np.float32))
+
+        img = pgzip.load_nifti(self.fname, threads=2)
+        np.testing.assert_array_equal(dat, img.get_fdata(dtype=np.float32))
+        np.testing.assert_array_equal(aff, img.affine)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,220 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from pijp_dti import repo
+
+
+class Connection(object):
+    """Answers queries with canned rows and records them."""
+
+    def __init__(self, rows=None):
+        self.rows = {} if rows is None else rows
+        self.queries = []
+
+    def setdb(self, db):
+        pass
+
+    def fetchone(self, sql):
+        self.queries.append(sql)
+        for text, row in self.rows.items():
+            if text in sql:
+                return row
+        return None
+
+    def fetchall(self, sql):
+        return self.fetchone(sql) or []
+
+
+
+class PymssqlConnection(object):
+    """Records the calls made to a pymssql connection and its cursor."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    def cursor(self):
+        return self
+
+    def executemany(self, sql, params):
+        self.calls.append(('executemany', sql, params))
+        if self.error is not None:
+            raise self.error
+
+    def commit(self):
+        self.calls.append(('commit',))
+
+    def rollback(self):
+        self.calls.append(('rollback',))
+
+    def close(self):
+        self.calls.append(('close',))
+
+
+def make_repo(rows=None, error=None):
+    dti_repo = repo.DTIRepo.__new__(repo.DTIRepo)
+    dti_repo.connection = Connection(rows)
+    dti_repo.connection.connection = PymssqlConnection(error)
+    return dti_repo
+
+
+class SharedRepo(object):
+    """Counts the repositories made and answers health checks."""
+
+    made = 0
+    alive = True
+
+    def __init__(self):
+        SharedRepo.made += 1
+
+    def is_alive(self):
+        return SharedRepo.alive
+
+
+class GetRepoTest(unittest.TestCase):
+
+    def setUp(self):
+
+        SharedRepo.made = 0
+        SharedRepo.alive = True
+        self.now = 1000.0
+        patches = [
+            mock.patch.object(repo, 'DTIRepo', SharedRepo),
+            mock.patch.dict(repo._SHARED, {'repo': None, 'pid': None,
+                                           'used': 0.0}),
+            mock.patch.object(repo.time, 'monotonic', lambda: self.now)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_reuse(self):
+
+        first = repo.get_repo()
+        self.now += repo.HEALTH_CHECK_INTERVAL / 2
+        self.assertIs(first, repo.get_repo())
+        self.assertEqual(1, SharedRepo.made)
+
+    def test_health_check(self):
+
+        first = repo.get_repo()
+        self.now += repo.HEALTH_CHECK_INTERVAL + 1
+        self.assertIs(first, repo.get_repo())
+
+        SharedRepo.alive = False
+        self.now += repo.HEALTH_CHECK_INTERVAL / 2
+        self.assertIs(first, repo.get_repo())
+        self.now += repo.HEALTH_CHECK_INTERVAL + 1
+        self.assertIsNot(first, repo.get_repo())
+        self.assertEqual(2, SharedRepo.made)
+
+    def test_fork(self):
+
+        first = repo.get_repo()
+        with mock.patch.object(repo.os, 'getpid', lambda: -1):
+            child = repo.get_repo()
+            self.assertIs(child, repo.get_repo())
+        self.assertIsNot(first, child)
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+
+        repo.DTIRepo.invalidate()
+
+    def test_registration_profile(self):
+
+        rows = {'COL_LENGTH': {'Length': None},
+                'FROM Projects': {'ProjectID': 1}}
+        self.assertEqual('default',
+                         make_repo(rows).get_registration_profile('a'))
+
+        rows['COL_LENGTH'] = {'Length': 40}
+        rows['RegistrationProfile\n'] = {'RegistrationProfile': None}
+        self.assertEqual('default',
+                         make_repo(rows).get_registration_profile('b'))
+
+        rows['RegistrationProfile\n'] = {'RegistrationProfile': 'fast'}
+        self.assertEqual('fast',
+                         make_repo(rows).get_registration_profile('c'))
+
+    def test_cached_lookup(self):
+
+        rows = {'FROM Projects': {'ProjectID': 1}}
+        dti_repo = make_repo(rows)
+        now = [1000.0]
+        with mock.patch.object(repo.time, 'monotonic', lambda: now[0]):
+            self.assertEqual(1, dti_repo.get_project_id('a'))
+            rows['FROM Projects'] = {'ProjectID': 2}
+            self.assertEqual(1, dti_repo.get_project_id('a'))
+            self.assertEqual(2, dti_repo.get_project_id('b'))
+
+            now[0] += repo.LOOKUP_TTL + 1
+            self.assertEqual(2, dti_repo.get_project_id('a'))
+            self.assertEqual(2, dti_repo.get_project_id('b'))
+
+            rows['FROM Projects'] = {'ProjectID': 3}
+            repo.DTIRepo.invalidate('a')
+            self.assertEqual(3, dti_repo.get_project_id('a'))
+            self.assertEqual(2, dti_repo.get_project_id('b'))
+            repo.DTIRepo.invalidate()
+            self.assertEqual(3, dti_repo.get_project_id('b'))
+
+    def test_none_not_cached(self):
+
+        rows = {}
+        dti_repo = make_repo(rows)
+        self.assertIsNone(dti_repo.get_project_id('a'))
+        rows['FROM Projects'] = {'ProjectID': 1}
+        self.assertEqual(1, dti_repo.get_project_id('a'))
+
+    def test_get_t1s(self):
+
+        rows = {"ImageType='T1'": [
+            {'ScanCode': 's1', 'Code': 't1'},
+            {'ScanCode': 's2', 'Code': 't2'},
+            {'ScanCode': 's1', 'Code': 't1-repeat'}]}
+        self.assertEqual({'s1': 't1', 's2': 't2'},
+                         make_repo(rows).get_t1s('a'))
+
+    def _write_stats(self, tmp):
+
+        measures = []
+        for measure in ['md', 'fa', 'ga', 'rd', 'ad']:
+            fname = os.path.join(tmp, f'c_{measure}_roi.csv')
+            with open(fname, 'w') as f:
+                f.write("Roi,Min,Max,Mean,Std,Median,Volume\n"
+                        "o'brien,0,1,0.5,0.1,0.5,10\n")
+            measures.append(fname)
+        return measures
+
+    def test_set_roi_stats(self):
+
+        dti_repo = make_repo()
+        with tempfile.TemporaryDirectory() as tmp:
+            dti_repo.set_roi_stats(3, 'c', *self._write_stats(tmp))
+
+        conn = dti_repo.connection.connection
+        self.assertEqual(['executemany', 'commit', 'close'],
+                         [call[0] for call in conn.calls])
+        sql, params = conn.calls[0][1:]
+        self.assertNotIn('XACT_ABORT', sql)
+        self.assertEqual(5, len(params))
+        self.assertEqual(('c', 3, 'c_md_roi.csv', 'md', "o'brien", '0', '1',
+                          '0.5', '0.1', '0.5', '10'), params[0][:-1])
+
+    def test_set_roi_stats_rollback(self):
+
+        dti_repo = make_repo(error=ValueError('duplicate'))
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(ValueError):
+                dti_repo.set_roi_stats(3, 'c', *self._write_stats(tmp))
+
+        self.assertEqual(['executemany', 'rollback', 'close'],
+                         [call[0] for call in
+                          dti_repo.connection.connection.calls])
+
+if __name__ == "__main__":
+    unittest.main()